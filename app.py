@@ -1,17 +1,12 @@
 import dash
-from dash import html, Output, Input, State, ALL
+from dash import html, dcc, Output, Input, State, ALL
 import dash_labs as dl
 import dash_bootstrap_components as dbc
-
-# from dash.long_callback import DiskcacheLongCallbackManager
-
-# from flask_caching import Cache
+import plotly.io as pio
 
 from dash_bootstrap_templates import load_figure_template
 
-# import diskcache
-# cache = diskcache.Cache("./cache-directory")
-# long_callback_manager = DiskcacheLongCallbackManager(cache)
+from src import geometry, jobs, metrics, tiles
 
 dbc_css = (
     "https://cdn.jsdelivr.net/gh/AnnMarieW/dash-bootstrap-templates@V1.0.4/dbc.min.css"
@@ -23,9 +18,12 @@ app = dash.Dash(
     __name__,
     plugins=[dl.plugins.pages],
     external_stylesheets=[dbc.themes.MINTY, dbc.icons.FONT_AWESOME, dbc_css],
+    long_callback_manager=jobs.manager,
 )
-
-# cache = Cache(app.server, config={"CACHE_TYPE": "filesystem", "CACHE_DIR": "cache"})
+jobs.register(app)
+metrics.init_app(app.server)
+geometry.init_app(app.server)
+tiles.init_app(app.server)
 
 # dash.register_page("home", layout="We're home!", path="/")
 LOGO = r"./assets/logo.png"
@@ -58,6 +56,11 @@ app.layout = dbc.Container(
         navbar,
         dbc.Row(navbuttons, justify="center"),
         dl.plugins.page_container,
+        # Template of the figures drawn by the clientside callbacks (assets/)
+        dcc.Store(
+            id="figure-template",
+            data=pio.templates[pio.templates.default].to_plotly_json(),
+        ),
     ],
     className="dbc",
     fluid=True,
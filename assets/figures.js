@@ -0,0 +1,88 @@
+// Figures redrawn in the browser from the aggregates the server callbacks
+// store (gen-data, distr-od), so that view-only controls need no round trip.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    agro: {
+        generationGraph: function (data, graphType, sort, template) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+            const table = data[graphType];
+            const order = table.index.map((_, i) => i);
+            if (sort && sort.length) {
+                const totals = table.values.map((row) =>
+                    row.reduce((a, b) => a + b, 0)
+                );
+                order.sort((a, b) => totals[b] - totals[a]);
+            }
+            const x = order.map((i) => table.index[i]);
+            const traces = table.columns.map((name, j) => ({
+                type: "bar",
+                name: name,
+                legendgroup: name,
+                x: x,
+                y: order.map((i) => table.values[i][j]),
+                hovertemplate:
+                    `${data.products_type}=${name}<br>` +
+                    `${graphType}=%{x}<br>quantity_tn=%{y}<extra></extra>`,
+            }));
+            return {
+                data: traces,
+                layout: {
+                    template: template,
+                    barmode: "relative",
+                    xaxis: {title: {text: graphType}},
+                    yaxis: {title: {text: "quantity_tn"}},
+                    legend: {
+                        title: {text: data.products_type},
+                        orientation: "h",
+                        yanchor: "bottom",
+                        y: 1.02,
+                        xanchor: "right",
+                        x: 1,
+                    },
+                },
+            };
+        },
+
+        heatmap: function (data, thresh, template) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+            thresh = Number(thresh) || 0;
+            const z = data.z.map((row) =>
+                row.map((v) => (v !== null && v > thresh ? v : null))
+            );
+            // Drop the origins and destinations left without any flow
+            const rows = z
+                .map((_, i) => i)
+                .filter((i) => z[i].some((v) => v !== null));
+            const cols = data.x
+                .map((_, j) => j)
+                .filter((j) => rows.some((i) => z[i][j] !== null));
+            const colorscale = template && template.layout.colorscale;
+            return {
+                data: [
+                    {
+                        type: "heatmap",
+                        x: cols.map((j) => data.x[j]),
+                        y: rows.map((i) => data.y[i]),
+                        z: rows.map((i) => cols.map((j) => z[i][j])),
+                        coloraxis: "coloraxis",
+                        hovertemplate:
+                            "destination_nuts: %{x}<br>origin_nuts: %{y}<br>" +
+                            "quantity_tn: %{z}<extra></extra>",
+                    },
+                ],
+                layout: {
+                    template: template,
+                    xaxis: {scaleanchor: "y", constrain: "domain"},
+                    yaxis: {autorange: "reversed", constrain: "domain"},
+                    coloraxis: {
+                        colorscale: colorscale ? colorscale.sequential : undefined,
+                    },
+                    margin: {t: 60},
+                },
+            };
+        },
+    },
+});
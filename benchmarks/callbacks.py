@@ -0,0 +1,219 @@
+"""Time the page callbacks on synthetic datasets of increasing size.
+
+    python benchmarks/callbacks.py --scale small --scale medium
+    python benchmarks/callbacks.py --compare benchmarks/results/<previous>.json
+
+Datasets are generated once per scale under benchmarks/data/. Each scale is
+benchmarked in its own process, since the data store is process-wide.
+"""
+import argparse
+import datetime
+import inspect
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, "benchmarks", "data")
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+SCALES = {
+    "small": dict(n_nuts=13, n_products=10, months=12, grid=20),
+    "medium": dict(n_nuts=52, n_products=30, months=12, grid=40),
+    "large": dict(n_nuts=52, n_products=200, months=24, grid=100),
+    "xlarge": dict(n_nuts=200, n_products=500, months=36, grid=200),
+}
+
+
+def dataset(scale):
+    path = os.path.join(DATA_DIR, scale)
+    if not os.path.isdir(path):
+        from src.synth import generate, save
+
+        save(generate(**SCALES[scale]), path)
+    return path
+
+
+def cases():
+    from src.io import store
+
+    nuts = store["nuts3"].index
+    products = list(store["products"].unique("product_name")[:2])
+    year = store.years()[0]
+    sel_nuts = list(nuts[:3])
+    links = store["incidence"].links
+    click = {"points": [{"customdata": int(links[len(links) // 2])}]}
+    closed = [int(links[len(links) // 3]), int(links[len(links) // 2])]
+
+    return {
+        "generation.update_view": {
+            "all": (
+                None,
+                "production",
+                year,
+                [1, 12],
+                None,
+                "product_group",
+                None,
+            ),
+            "filtered": (
+                None,
+                "consumption",
+                year,
+                [3, 9],
+                sel_nuts,
+                "product_name",
+                products,
+            ),
+        },
+        "distribution.update_visuals": {
+            "all": (None, "origin", None, sel_nuts, year),
+            "filtered": (None, "destination", products, sel_nuts, year),
+            "gravity": (None, "origin", None, sel_nuts, year, "gravity"),
+        },
+        "assignment.assignment_map": {
+            "all": (None, None, year),
+            "filtered": (sel_nuts, products, year),
+        },
+        "assignment.update_breakdown": {
+            "all": (None, None, None, year),
+            "filtered": (None, sel_nuts, products, year),
+        },
+        "assignment.update_select_link": {
+            "all": (click, None, None, year),
+            "filtered": (click, sel_nuts, products, year),
+        },
+        "assignment.update_closure": {
+            "all": (None, closed, None, None, year),
+            "filtered": (None, closed, sel_nuts, products, year),
+        },
+    }
+
+
+def payload(result):
+    import dash
+    import plotly
+
+    outputs = result if isinstance(result, tuple) else (result,)
+    return sum(
+        len(json.dumps(output, cls=plotly.utils.PlotlyJSONEncoder))
+        for output in outputs
+        if output is not dash.no_update
+    )
+
+
+def run(path, repeat):
+    """Benchmark the callbacks against the dataset at ``path`` (child process)."""
+    os.environ["AGRO_DATA"] = path
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+
+    import app  # noqa: F401, imports the pages
+    from src.io import store
+
+    results = []
+    for name, calls in cases().items():
+        module, func = name.split(".")
+        # Bypass the dash and memoization wrappers
+        func = inspect.unwrap(getattr(sys.modules[f"pages.{module}"], func))
+        for case, args in calls.items():
+            timings = []
+            for _ in range(repeat + 1):
+                start = time.perf_counter()
+                result = func(*args)
+                timings.append(time.perf_counter() - start)
+            results.append(
+                {
+                    "callback": name,
+                    "case": case,
+                    "cold": timings[0],
+                    "min": min(timings[1:]),
+                    "median": statistics.median(timings[1:]),
+                    "bytes": payload(result),
+                }
+            )
+    return {"results": results, "loads": store.stats}
+
+
+def compare(current, previous):
+    key = lambda r: (r["scale"], r["callback"], r["case"])
+    before = {key(r): r for r in previous["results"]}
+    print(f"{'scale':8} {'callback':32} {'case':9} {'before':>9} {'after':>9} ratio")
+    for r in current["results"]:
+        if key(r) not in before:
+            continue
+        old = before[key(r)]["median"]
+        print(
+            f"{r['scale']:8} {r['callback']:32} {r['case']:9} "
+            f"{old * 1000:8.1f}ms {r['median'] * 1000:8.1f}ms {r['median'] / old:5.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", action="append", choices=SCALES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out")
+    parser.add_argument("--compare")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        json.dump(run(args.run, args.repeat), sys.stdout)
+        return
+
+    sys.path.insert(0, ROOT)
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip(),
+        "results": [],
+        "loads": {},
+    }
+    for scale in args.scale or ["small", "medium"]:
+        child = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--run",
+                dataset(scale),
+                "--repeat",
+                str(args.repeat),
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        output = json.loads(child.stdout)
+        report["results"] += [dict(r, scale=scale) for r in output["results"]]
+        report["loads"][scale] = output["loads"]
+
+    for r in report["results"]:
+        print(
+            f"{r['scale']:8} {r['callback']:32} {r['case']:9} "
+            f"cold {r['cold'] * 1000:8.1f}ms  median {r['median'] * 1000:8.1f}ms  "
+            f"{r['bytes'] / 1024:8.1f} kB"
+        )
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out = args.out or os.path.join(
+        RESULTS_DIR, f"{report['created'].replace(':', '')}-{report['commit']}.json"
+    )
+    with open(out, "w") as handle:
+        json.dump(report, handle, indent=2)
+    print(f"results written to {out}")
+
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(report, json.load(handle))
+
+
+if __name__ == "__main__":
+    main()
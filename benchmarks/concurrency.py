@@ -0,0 +1,93 @@
+"""Call the page callbacks from many threads and check their outputs.
+
+    python benchmarks/concurrency.py --scale small --threads 16 --calls 400
+
+The cases of benchmarks/callbacks.py are called in random order from a
+thread pool, on a cold process: the datasets load, and the memoization and
+path caches fill, while the threads run. Half of the calls go through the
+memoization of the callback. The outputs are then compared with those of
+the cases run serially; a difference means a callback shared state it
+should not have, and the script exits non-zero.
+"""
+import argparse
+import inspect
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from callbacks import ROOT, SCALES, cases, dataset
+
+
+def encode(result):
+    import dash
+    import plotly
+
+    outputs = result if isinstance(result, tuple) else (result,)
+    return [
+        json.dumps(output, cls=plotly.utils.PlotlyJSONEncoder, sort_keys=True)
+        for output in outputs
+        if output is not dash.no_update
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ["AGRO_DATA"] = dataset(args.scale)
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+
+    import app  # noqa: F401, imports the pages
+
+    calls = []
+    for name, arguments in cases().items():
+        module, func = name.split(".")
+        func = getattr(sys.modules[f"pages.{module}"], func)
+        # Below the dash wrapper, with the instrumentation and memoization
+        wrapped = inspect.unwrap(
+            func, stop=lambda f: f.__code__.co_filename.startswith(ROOT)
+        )
+        bare = inspect.unwrap(func)
+        calls += [(f"{name}/{case}", wrapped, bare, a) for case, a in arguments.items()]
+
+    rng = random.Random(args.seed)
+    order = [
+        (name, rng.choice([wrapped, bare]), a)
+        for name, wrapped, bare, a in rng.choices(calls, k=args.calls)
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        outputs = list(pool.map(lambda call: encode(call[1](*call[2])), order))
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    references = {name: encode(bare(*a)) for name, _, bare, a in calls}
+    serial = time.perf_counter() - start
+
+    mismatches = sorted(
+        {
+            name
+            for (name, _, _), output in zip(order, outputs)
+            if output != references[name]
+        }
+    )
+    for name in mismatches:
+        print(f"mismatch: {name}")
+    print(
+        f"{args.calls} calls on {args.threads} threads in {elapsed:.1f}s "
+        f"(serial pass of {len(calls)} cases {serial:.1f}s), "
+        f"{len(mismatches)} mismatching cases"
+    )
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,25 @@
+import uuid
+from urllib.parse import urljoin
+
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
 import plotly.express as px
+import plotly.graph_objects as go
 import dash
 from dash import html, dcc, callback, Input, Output, State
 import dash_bootstrap_components as dbc
 
-from src.io import fetch_data
+from src.io import partition, projection, store
+from src.cache import memoize
+from src.metrics import instrument, stage
+from src import jobs
+from src.jobs import long_callback, job_slot
+from src.network import assign_selection, close_links, select_link
+from src import equilibrium
+from src import tiles
+from src.geometry import center, volume_classes
 from src.utils import rename_nuts, pairwise
 
 # dash.register_page(__name__)
@@ -19,20 +32,16 @@ dash.register_page(
     icon="fa fa-road",
 )
 
-
-data = fetch_data()
-epsgs = data["epsgs"]
-nuts = data["nuts"]
-nuts = nuts[(nuts["LEVL_CODE"] == 3) & (nuts["CNTR_CODE"] == "EL")]
-
-prods = data["prods"]
-ods = data["ods"]
-net = data["net"]
-links = data["links"]
-spaths = data["spaths"]
+# Lifetime (s) of the link volumes kept per session for incremental updates
+SESSION_TTL = 3600
+# Links of the per-product breakdown, the most loaded ones
+TOP_LINKS = 20
+# OD pairs shown of a selected link, the largest flows
+TOP_PAIRS = 20
 
 
 def layout():
+    nuts = store["nuts3"]
 
     controls = dbc.Card(
         [
@@ -46,9 +55,10 @@ def layout():
                                     dbc.Select(
                                         id="input-year",
                                         options=[
-                                            {"label": "2018", "value": 2018},
+                                            {"label": str(year), "value": year}
+                                            for year in store.years()
                                         ],
-                                        value=2018,
+                                        value=store.years()[-1],
                                     ),
                                 ],
                                 width=2,
@@ -73,7 +83,7 @@ def layout():
                                 [
                                     dbc.Label("Προϊντα"),
                                     dcc.Dropdown(
-                                        options=prods.index.unique(
+                                        options=store["products"].unique(
                                             level="product_name"
                                         ),
                                         multi=True,
@@ -81,6 +91,64 @@ def layout():
                                     ),
                                 ]
                             ),
+                            dbc.Col(
+                                [
+                                    dbc.Label("Απεικόνιση"),
+                                    dbc.RadioItems(
+                                        options=[
+                                            {"label": "Γραμμές", "value": "lines"},
+                                            {"label": "Πολύγωνα", "value": "polygons"},
+                                            {"label": "Πλακίδια", "value": "tiles"},
+                                        ],
+                                        value="lines",
+                                        id="input-link-style",
+                                    ),
+                                ],
+                                width=2,
+                            ),
+                        ]
+                    ),
+                    dbc.Row(
+                        [
+                            dbc.Col(
+                                [
+                                    dbc.Label("Φόρτιση"),
+                                    dbc.RadioItems(
+                                        options=[
+                                            {"label": "Όλα ή τίποτα", "value": "aon"},
+                                            {"label": "Frank-Wolfe", "value": "fw"},
+                                            {"label": "MSA", "value": "msa"},
+                                        ],
+                                        value="aon",
+                                        id="input-assign-mode",
+                                        inline=True,
+                                    ),
+                                ]
+                            ),
+                            dbc.Col(
+                                [
+                                    dbc.Label("Επαναλήψεις"),
+                                    dbc.Input(
+                                        id="input-max-iterations",
+                                        type="number",
+                                        min=1,
+                                        value=equilibrium.MAX_ITERATIONS,
+                                    ),
+                                ],
+                                width=2,
+                            ),
+                            dbc.Col(
+                                [
+                                    dbc.Label("Χρονικό όριο (s)"),
+                                    dbc.Input(
+                                        id="input-time-limit",
+                                        type="number",
+                                        min=1,
+                                        value=equilibrium.TIME_LIMIT,
+                                    ),
+                                ],
+                                width=2,
+                            ),
                         ]
                     ),
                 ],
@@ -89,8 +157,38 @@ def layout():
         ]
     )
 
+    scenario = dbc.Card(
+        [
+            dbc.CardBody(
+                [
+                    dbc.Label("Κλειστά τμήματα (osmid)"),
+                    # Filled with the links clicked on the map or typed, see
+                    # add_closed_link
+                    dcc.Dropdown(
+                        options=[],
+                        multi=True,
+                        id="input-closed-links",
+                    ),
+                ]
+            ),
+            dbc.CardFooter(
+                [
+                    dbc.Button(
+                        "Προσθήκη επιλεγμένου",
+                        id="input-close-clicked",
+                        color="secondary",
+                        class_name="me-2",
+                    ),
+                    dbc.Button("Εκτίμηση", id="input-closure"),
+                ]
+            ),
+        ]
+    )
+
     layout = html.Div(
         [
+            dcc.Store(id="assign-session", data=uuid.uuid4().hex),
+            dcc.Location(id="assign-location"),
             dbc.Row(
                 [html.H2("Επιπτώσεις στο οδικό δίκτυο"), html.H4("(Φόρτιση δικτύου)")]
             ),
@@ -100,6 +198,9 @@ def layout():
                         dbc.Accordion(
                             [
                                 dbc.AccordionItem(controls, title="Φίλτρα"),
+                                dbc.AccordionItem(
+                                    scenario, title="Σενάριο κλεισίματος"
+                                ),
                             ]
                         )
                     ),
@@ -116,20 +217,58 @@ def layout():
                                         dbc.Row(
                                             [
                                                 dbc.Col(
-                                                    dbc.Spinner(
+                                                    [
+                                                        dbc.Progress(
+                                                            id="assign-progress",
+                                                            striped=True,
+                                                            animated=True,
+                                                            style={
+                                                                "visibility": "hidden"
+                                                            },
+                                                        ),
                                                         dcc.Graph(
                                                             id="assign-map",
                                                             style={
                                                                 "height": "40vh",
                                                                 "width": "100%",
                                                             },
-                                                        )
+                                                        ),
+                                                    ],
+                                                    width=4,
+                                                ),
+                                                dbc.Col(
+                                                    dcc.Graph(
+                                                        id="assign-gap",
+                                                        style={"height": "40vh"},
+                                                    ),
+                                                    width=4,
+                                                ),
+                                                dbc.Col(
+                                                    dcc.Graph(
+                                                        id="assign-breakdown",
+                                                        style={"height": "40vh"},
                                                     ),
                                                     width=4,
                                                 ),
                                             ],
                                             justify="center",
-                                        )
+                                        ),
+                                        dbc.Row(
+                                            [
+                                                dbc.Col(
+                                                    dcc.Graph(
+                                                        id="assign-select-link",
+                                                        style={"height": "40vh"},
+                                                    ),
+                                                ),
+                                                dbc.Col(
+                                                    dcc.Graph(
+                                                        id="assign-closure",
+                                                        style={"height": "40vh"},
+                                                    ),
+                                                ),
+                                            ]
+                                        ),
                                     ],
                                     title="Visuals",
                                 ),
@@ -145,64 +284,411 @@ def layout():
     return layout
 
 
-@callback(
+@long_callback(
     Output("assign-map", "figure"),
+    Output("assign-gap", "figure"),
     Input("input-update", "n_clicks"),
     State("input-nuts", "value"),
     State("input-products", "value"),
+    State("input-year", "value"),
+    State("input-link-style", "value"),
+    State("input-assign-mode", "value"),
+    State("input-max-iterations", "value"),
+    State("input-time-limit", "value"),
+    State("assign-location", "href"),
+    State("assign-session", "data"),
+    progress=[Output("assign-progress", "value"), Output("assign-progress", "label")],
+    running=[
+        (
+            Output("assign-progress", "style"),
+            {"visibility": "visible"},
+            {"visibility": "hidden"},
+        )
+    ],
+    prefetch=[
+        "nuts_bounds",
+        "incidence",
+        "ods:{year}",
+        "link_cells:{year}",
+        "link_lines",
+        "link_polygons",
+        "link_mercator",
+        "path_engine",
+        "bpr_links",
+    ],
+)
+def update_map(
+    set_progress,
+    click,
+    sel_nuts,
+    products,
+    year,
+    style,
+    mode,
+    max_iterations,
+    time_limit,
+    href,
+    session,
+):
+    origin = urljoin(href, "/") if href else None
+    with job_slot(waiting=lambda: set_progress((0, "Σε αναμονή"))):
+        return assignment_map(
+            sel_nuts,
+            products,
+            year,
+            style,
+            origin,
+            mode,
+            max_iterations,
+            time_limit,
+            session,
+            set_progress,
+        )
+
+
+@callback(
+    Output("assign-breakdown", "figure"),
+    Input("input-update", "n_clicks"),
+    State("input-nuts", "value"),
+    State("input-products", "value"),
+    State("input-year", "value"),
+)
+@instrument
+@memoize(ignore=["click"])
+def update_breakdown(click, sel_nuts, products, year=None):
+    """Per-product volumes of the most loaded links (all-or-nothing)."""
+    year = int(year) if year else store.years()[-1]
+    with stage("breakdown") as st:
+        # Column sums of the materialized link x (product, origin) volumes
+        df = store[partition("link_cells", year)].breakdown(products, sel_nuts)
+        df = df.loc[df.sum(axis=1).nlargest(TOP_LINKS).index]
+        df = df.loc[:, df.sum() > 0]
+        st.rows = df.size
+
+    df.index = df.index.astype(str)
+    fig = px.bar(df, labels={"osmid": "link", "value": "volume"})
+    fig.update_layout(
+        xaxis_type="category",
+        legend_title_text="product_name",
+        margin=dict(l=0, r=0, t=0, b=0),
+    )
+    return fig
+
+
+def clicked_link(click):
+    """Osmid of the link clicked on the map, line or polygon style."""
+    if not click:
+        return None
+    point = click["points"][0]
+    osmid = point.get("customdata", point.get("location"))
+    return None if osmid is None else int(osmid)
+
+
+@callback(
+    Output("assign-select-link", "figure"),
+    Input("assign-map", "clickData"),
+    State("input-nuts", "value"),
+    State("input-products", "value"),
+    State("input-year", "value"),
+)
+@instrument
+def update_select_link(click, sel_nuts, products, year=None):
+    """OD flows, by product, of the selection that use the clicked link."""
+    osmid = clicked_link(click)
+    if osmid is None:
+        return dash.no_update
+    year = int(year) if year else store.years()[-1]
+
+    with stage("select-link") as st:
+        flows = select_link(osmid, products, sel_nuts, year)
+        cols = ["origin_nuts", "destination_nuts", "product_name"]
+        df = flows.groupby(cols, observed=True).sum().rename("quantity_tn")
+        st.rows = len(df)
+
+    pairs = df.groupby(level=cols[:2], observed=True).sum().nlargest(TOP_PAIRS)
+    df = df.reset_index(level="product_name")
+    df = df.loc[df.index.isin(pairs.index)].reset_index()
+    df = rename_nuts(store[projection("nuts", "NUTS_NAME")], df, cols[:2], trim_len=15)
+    df["pair"] = (
+        df["origin_nuts"].astype(str) + " → " + df["destination_nuts"].astype(str)
+    )
+    fig = px.bar(
+        df.sort_values("quantity_tn", ascending=False),
+        x="pair",
+        y="quantity_tn",
+        color="product_name",
+        title=f"link {osmid}: {flows.sum():,.0f} tn",
+    )
+    fig.update_layout(xaxis_title=None)
+    return fig
+
+
+def network_link(search):
+    """Osmid typed in the closed-links dropdown, None unless a network link."""
+    search = (search or "").strip()
+    if not search.isdigit():
+        return None
+    osmids = store["path_engine"].links["osmid"].to_numpy()
+    return int(search) if (osmids == int(search)).any() else None
+
+
+@callback(
+    Output("input-closed-links", "options"),
+    Output("input-closed-links", "value"),
+    Input("input-close-clicked", "n_clicks"),
+    Input("input-closed-links", "search_value"),
+    State("assign-map", "clickData"),
+    State("input-closed-links", "value"),
+    prevent_initial_call=True,
+)
+def add_closed_link(click, search, map_click, closed):
+    """The closed links as options, and the one typed or clicked on the map."""
+    closed = closed or []
+    triggered = dash.callback_context.triggered[0]["prop_id"]
+    if triggered == "input-close-clicked.n_clicks":
+        osmid = clicked_link(map_click)
+        if osmid is None or osmid in closed:
+            return dash.no_update, dash.no_update
+        closed = closed + [osmid]
+        return [{"label": str(o), "value": o} for o in closed], closed
+
+    # Typed: offered once it is the osmid of a link of the road network
+    options = [{"label": str(o), "value": o} for o in closed]
+    osmid = network_link(search)
+    if osmid is not None and osmid not in closed:
+        options.append({"label": str(osmid), "value": osmid})
+    return options, dash.no_update
+
+
+def closure_figure(volumes, closed, stranded):
+    """Links whose volume rises or falls with the ``closed`` links, and those."""
+    lines = store["link_lines"]
+    change = volumes["scenario"] - volumes["base"]
+    fig = go.Figure()
+    for name, osmids, color in (
+        ("αύξηση", change.index[change > 0], "firebrick"),
+        ("μείωση", change.index[change < 0], "royalblue"),
+        ("κλειστά", pd.Index(closed), "black"),
+    ):
+        lon, lat, osmids = lines.coordinates(osmids, ids=True)
+        fig.add_trace(
+            go.Scattermapbox(
+                lon=lon,
+                lat=lat,
+                mode="lines",
+                line=dict(width=3, color=color),
+                name=name,
+                customdata=np.c_[osmids, change.reindex(osmids).fillna(0)],
+                hovertemplate="%{customdata[0]}: %{customdata[1]:+,.0f} tn",
+            )
+        )
+
+    fig.update_layout(
+        mapbox=dict(style="carto-positron", center=center(), zoom=10),
+        title=f"χωρίς διαδρομή: {stranded:,.0f} tn",
+        margin=dict(l=0, r=0, t=30, b=0),
+    )
+    return fig
+
+
+@callback(
+    Output("assign-closure", "figure"),
+    Input("input-closure", "n_clicks"),
+    State("input-closed-links", "value"),
+    State("input-nuts", "value"),
+    State("input-products", "value"),
+    State("input-year", "value"),
 )
-def update_map(click, sel_nuts, products):
-
-    # osmnuts = nuts.reset_index(drop=False).groupby("osmid").last()
-
-    color = None
-    odcols = ["origin_nuts", "destination_nuts"]
-    odsf = ods.copy()
-    if products:
-        odsf = ods.loc[products]
-    odsf = odsf.groupby(odcols).sum().sort_index()
-
-    dfs = []
-    for k, vol in odsf.iteritems():
-        src, tgt = k
-        src = nuts.at[src, "osmid"]
-        tgt = nuts.at[tgt, "osmid"]
-
-        if src == tgt:
-            continue
-
-        try:
-            path = spaths.at[(src, tgt)].to_frame(name="osmid")
-            path.loc[:, "volume"] = vol
-            dfs.append(path)
-        except KeyError:
-            continue
-
-    vols = pd.concat(dfs).groupby("osmid")["volume"].sum()
-    vols = vols[vols > 0]
-
-    dfp = links.set_index("osmid").join(vols, how="right")
-    dfp = dfp.dropna(subset=["geometry"])
-    dfp = gpd.GeoDataFrame(dfp, geometry=dfp.geometry).set_crs(epsg=epsgs["world"])
-    dfp = dfp.to_crs(epsg=epsgs["proj"])
-    dfp.geometry = dfp.buffer(2000)
-    dfp = dfp.to_crs(epsg=epsgs["world"])
-
-    bbox = nuts.total_bounds
-    center = {"lat": (bbox[1] + bbox[3]) / 2, "lon": (bbox[0] + bbox[2]) / 2}
-
-    fig = px.choropleth_mapbox(
-        dfp,
-        geojson=dfp.geometry,
-        locations=dfp.index,
-        color="volume",
-        center=center,
-        mapbox_style="carto-positron",
-        zoom=10,
+@instrument
+@memoize(ignore=["click"])
+def update_closure(click, closed, sel_nuts, products, year=None):
+    """Change of the link volumes of the selection with links closed."""
+    if not closed:
+        return dash.no_update
+    year = int(year) if year else store.years()[-1]
+    with stage("reroute") as st:
+        # Only the OD pairs through the closed links are rerouted
+        volumes, stranded = close_links(closed, products, sel_nuts, year)
+        st.rows = len(volumes)
+    with stage("figure"):
+        return closure_figure(volumes, closed, stranded)
+
+
+def class_style(k, n):
+    """Width and colour of volume class ``k`` of ``n``, heavier is wider and darker."""
+    colors = px.colors.sequential.Plasma_r
+    step = k / max(n - 1, 1)
+    return 1 + 5 * step, colors[round(step * (len(colors) - 1))]
+
+
+def lines_figure(lines, vols, center, bins=5):
+    """One line trace per volume class."""
+    edges, classes = volume_classes(vols, bins)
+    fig = go.Figure()
+    for k, (low, high) in enumerate(pairwise(edges)):
+        lon, lat, osmids = lines.coordinates(vols.index[classes == k], ids=True)
+        width, color = class_style(k, len(edges) - 1)
+        fig.add_trace(
+            go.Scattermapbox(
+                lon=lon,
+                lat=lat,
+                mode="lines",
+                line=dict(width=width, color=color),
+                name=f"{low:,.0f} - {high:,.0f}",
+                hoverinfo="name",
+                # The link of every point, for select-link clicks
+                customdata=osmids,
+            )
+        )
+
+    fig.update_layout(
+        mapbox=dict(style="carto-positron", center=center, zoom=10),
+        legend_title_text="volume",
+        margin=dict(l=0, r=0, t=0, b=0),
     )
+    return fig
+
+
+def tiles_figure(lines, vols, center, origin, bins=5):
+    """Volume classes drawn from the vector tiles of src.tiles, one layer each.
+
+    The tiles cannot be clicked: an invisible marker at the middle of every
+    link carries it, for select-link and the closure scenario.
+    """
+    key, edges = tiles.publish(vols, bins)
+    # Tiles are fetched by mapbox workers, which need absolute URLs
+    source = urljoin(origin, tiles.tile_url(key))
+    fig = go.Figure()
+    layers = []
+    for k, (low, high) in enumerate(pairwise(edges)):
+        width, color = class_style(k, len(edges) - 1)
+        # Empty traces, for the legend
+        fig.add_trace(
+            go.Scattermapbox(
+                lon=[],
+                lat=[],
+                mode="lines",
+                line=dict(width=width, color=color),
+                name=f"{low:,.0f} - {high:,.0f}",
+            )
+        )
+        layers.append(
+            dict(
+                sourcetype="vector",
+                source=[source],
+                sourcelayer=tiles.layer_name(k),
+                type="line",
+                color=color,
+                line=dict(width=width),
+            )
+        )
+
+    lon, lat, osmids = lines.midpoints(vols.index)
+    fig.add_trace(
+        go.Scattermapbox(
+            lon=lon,
+            lat=lat,
+            mode="markers",
+            marker=dict(size=10, opacity=0),
+            customdata=osmids,
+            hovertext=[
+                f"{osmid}: {vol:,.0f}" for osmid, vol in vols.reindex(osmids).items()
+            ],
+            hoverinfo="text",
+            showlegend=False,
+        )
+    )
+    fig.update_layout(
+        mapbox=dict(style="carto-positron", center=center, zoom=10, layers=layers),
+        legend_title_text="volume",
+        margin=dict(l=0, r=0, t=0, b=0),
+    )
+    return fig
+
+
+def gap_figure(gaps):
+    """Relative gap of the equilibrium iterations, log scale."""
+    fig = go.Figure(
+        go.Scatter(x=np.arange(1, len(gaps) + 1), y=gaps, mode="lines+markers")
+    )
+    fig.update_layout(
+        xaxis_title="iteration",
+        yaxis_title="relative gap",
+        yaxis_type="log",
+        margin=dict(l=0, r=0, t=0, b=0),
+    )
+    return fig
+
+
+@instrument
+@memoize(ignore=["session", "progress"], job=True)
+def assignment_map(
+    sel_nuts,
+    products,
+    year=None,
+    style="lines",
+    origin=None,
+    mode="aon",
+    max_iterations=None,
+    time_limit=None,
+    session=None,
+    progress=None,
+):
+    progress = progress or (lambda value: None)
+    year = int(year) if year else store.years()[-1]
+
+    progress((25, "Φόρτιση δικτύου"))
+    with stage("assignment") as st:
+        if mode in ("fw", "msa"):
+            # Congested loading on the road network, see src.equilibrium
+            vols, gaps = equilibrium.assign_equilibrium(
+                products,
+                sel_nuts,
+                year,
+                method=mode,
+                max_iterations=int(max_iterations or equilibrium.MAX_ITERATIONS),
+                time_limit=float(time_limit or equilibrium.TIME_LIMIT),
+                progress=lambda i, gap: progress((25, f"Επανάληψη {i}: {gap:.1e}")),
+            )
+        else:
+            # Only the selections added or removed since the session's last map
+            # are assigned, see src.network.assign_selection
+            key = f"assignment:{session}"
+            previous = jobs.cache.get(key) if session else None
+            volumes, state = assign_selection(products, sel_nuts, previous, year)
+            if session:
+                jobs.cache.set(key, state, expire=SESSION_TTL)
+            vols = pd.Series(volumes, index=store["incidence"].links, name="volume")
+            gaps = []
+
+        vols = vols.sort_index()
+        vols = vols[vols > 0]
+        st.rows = len(vols)
+
+    progress((75, "Χάρτης"))
+    with stage("figure") as st:
+        st.rows = len(vols)
+        if style == "polygons":
+            # Links buffered and simplified once, see src.geometry
+            polygons = store["link_polygons"]
+            dfp = polygons.to_frame().join(vols, how="right")
+            dfp = gpd.GeoDataFrame(dfp.dropna(subset=["geometry"]), crs=polygons.crs)
+            fig = px.choropleth_mapbox(
+                dfp,
+                geojson=dfp.geometry,
+                locations=dfp.index,
+                color="volume",
+                center=center(),
+                mapbox_style="carto-positron",
+                zoom=10,
+            )
+            fig.update_traces(marker=dict(line=dict(width=0)))
+        elif style == "tiles" and origin:
+            fig = tiles_figure(store["link_lines"], vols, center(), origin)
+        else:
+            fig = lines_figure(store["link_lines"], vols, center())
 
-    fig.update_traces(marker=dict(line=dict(width=0)))
     # fig.update_geos(fitbounds="geojson", visible=False)
     # fig.add_trace(fig_nuts.data[0])
 
-    return fig
+    return fig, gap_figure(gaps)
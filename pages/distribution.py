@@ -1,10 +1,16 @@
-import pandas as pd
+import numpy as np
 import plotly.express as px
 import dash
-from dash import html, dcc, callback, Input, Output, State
+from dash import html, dcc, callback, clientside_callback, ClientsideFunction
+from dash import Input, Output, State
 import dash_bootstrap_components as dbc
 
-from src.io import fetch_data
+from src.io import projection, store
+from src.cache import memoize
+from src.metrics import instrument, stage
+from src.aggregates import od_tensor
+from src import gravity
+from src.geometry import center, geojson_url
 from src.utils import rename_nuts
 
 # dash.register_page(__name__)
@@ -17,18 +23,9 @@ dash.register_page(
     icon="fa fa-table",
 )
 
-data = fetch_data()
-nuts = data["nuts"]
-nutsf = nuts[(nuts["LEVL_CODE"] == 3) & (nuts["CNTR_CODE"] == "EL")]
-
-distr = data["distr"]
-prods = data["prods"]
-cons = data["cons"]
-
-ods = data["ods"]
-
 
 def layout():
+    nutsf = store["nuts3"]
 
     controls = dbc.Card(
         [
@@ -42,9 +39,10 @@ def layout():
                                     dbc.Select(
                                         id="input-year",
                                         options=[
-                                            {"label": "2018", "value": 2018},
+                                            {"label": str(year), "value": year}
+                                            for year in store.years()
                                         ],
-                                        value=2018,
+                                        value=store.years()[-1],
                                     ),
                                 ],
                                 width=2,
@@ -89,7 +87,7 @@ def layout():
                                 [
                                     dbc.Label("Προϊντα"),
                                     dcc.Dropdown(
-                                        options=prods.index.unique(
+                                        options=store["products"].unique(
                                             level="product_name"
                                         ),
                                         multi=True,
@@ -99,6 +97,70 @@ def layout():
                             ),
                         ]
                     ),
+                    dbc.Row(
+                        [
+                            dbc.Col(
+                                [
+                                    dbc.Label("Πίνακας ΠΠ"),
+                                    dbc.RadioItems(
+                                        options=[
+                                            {"label": "Δεδομένα", "value": "observed"},
+                                            {"label": "Βαρυτικό", "value": "gravity"},
+                                        ],
+                                        value="observed",
+                                        id="input-od-model",
+                                        inline=True,
+                                    ),
+                                ]
+                            ),
+                            dbc.Col(
+                                [
+                                    dbc.Label("Συνάρτηση αποτροπής"),
+                                    dbc.Select(
+                                        options=[
+                                            {
+                                                "label": "Εκθετική",
+                                                "value": "exponential",
+                                            },
+                                            {"label": "Δύναμη", "value": "power"},
+                                        ],
+                                        value="exponential",
+                                        id="input-deterrence",
+                                    ),
+                                ],
+                                width=2,
+                            ),
+                            dbc.Col(
+                                [
+                                    dbc.Label("β"),
+                                    dbc.Input(
+                                        id="input-beta",
+                                        type="number",
+                                        min=0,
+                                        step="any",
+                                        placeholder=", ".join(
+                                            f"{name}: {beta}"
+                                            for name, beta in gravity.BETAS.items()
+                                        ),
+                                    ),
+                                ],
+                                width=3,
+                            ),
+                            dbc.Col(
+                                [
+                                    dbc.Label("Ανοχή σύγκλισης"),
+                                    dbc.Input(
+                                        id="input-tolerance",
+                                        type="number",
+                                        min=0,
+                                        step="any",
+                                        placeholder=str(gravity.TOLERANCE),
+                                    ),
+                                ],
+                                width=2,
+                            ),
+                        ]
+                    ),
                 ],
             ),
             dbc.CardFooter(dbc.Button("Ενημέρωση", id="input-update")),
@@ -149,10 +211,30 @@ def layout():
                                                     width=5,
                                                 ),
                                                 dbc.Col(
-                                                    dcc.Graph(
-                                                        id="distr-heatmap",
-                                                        style={"height": "50vh"},
-                                                    ),
+                                                    [
+                                                        dbc.InputGroup(
+                                                            [
+                                                                dbc.InputGroupText(
+                                                                    "Ελάχιστη ροή (tn)"
+                                                                ),
+                                                                dbc.Input(
+                                                                    id="input-heatmap-thresh",
+                                                                    type="number",
+                                                                    min=0,
+                                                                    value=20,
+                                                                ),
+                                                            ],
+                                                            size="sm",
+                                                        ),
+                                                        dcc.Graph(
+                                                            id="distr-heatmap",
+                                                            style={"height": "50vh"},
+                                                        ),
+                                                        # OD matrix of the last
+                                                        # update, thresholded in
+                                                        # the browser
+                                                        dcc.Store(id="distr-od"),
+                                                    ],
                                                     width=4,
                                                 ),
                                             ],
@@ -175,83 +257,101 @@ def layout():
 
 @callback(
     Output("distr-map", "figure"),
+    Output("distr-barchart", "figure"),
+    Output("distr-od", "data"),
     Input("input-update", "n_clicks"),
     State("input-direction", "value"),
     State("input-products", "value"),
     State("input-nuts", "value"),
+    State("input-year", "value"),
+    State("input-od-model", "value"),
+    State("input-deterrence", "value"),
+    State("input-beta", "value"),
+    State("input-tolerance", "value"),
 )
-def update_map(click, direction, products, sel_nuts):
-    color = None
-    odcols = ["origin_nuts", "destination_nuts"]
-    odsf = ods.copy()
-    if products:
-        odsf = ods.loc[products]
-    odsf = odsf.groupby(odcols).sum()
+@instrument
+@memoize(ignore=["click"])
+def update_visuals(
+    click,
+    direction,
+    products,
+    sel_nuts,
+    year=None,
+    model="observed",
+    deterrence="exponential",
+    beta=None,
+    tolerance=None,
+):
+    # The selected products are summed out of the shared tensor, not copied
+    with stage("aggregate") as st:
+        if model == "gravity":
+            # ods regenerated from prods and cons, see src.gravity
+            ods = gravity.gravity_tensor(year, deterrence, beta, tolerance)
+        else:
+            ods = od_tensor(year)
+        flows = ods.flows(direction, sel_nuts, products)
+        st.rows = len(ods.product_codes(products)) * len(ods.nuts) ** 2
 
-    if sel_nuts:
-        dfs = []
-        for s in sel_nuts:
-            try:
-                df = odsf.xs(s, level=f"{direction}_nuts")
-                df.index.name = "id"
-                dfs.append(df)
-            except KeyError:
-                pass
-        if dfs:
-            color = pd.concat(dfs).groupby(df.index.name).sum()
+    with stage("map"):
+        fig_map = update_map(flows, sel_nuts)
+    with stage("barchart"):
+        fig_barchart = update_barchart(flows)
+    with stage("heatmap"):
+        heatmap = heatmap_table(ods, products)
+    return fig_map, fig_barchart, heatmap
 
-    bbox = nutsf.total_bounds
-    center = {"lat": (bbox[1] + bbox[3]) / 2, "lon": (bbox[0] + bbox[2]) / 2}
-    if not color is None:
-        nutsf["quantity_tn"] = nutsf.join(color, how="left")["quantity_tn"].fillna(0)
+
+def update_map(flows, sel_nuts):
+    nutsf = store["nuts3"][[]].rename_axis("id")
+    color = None
+    if flows is not None:
+        color = flows.sum().rename_axis("id").rename("quantity_tn")
+        nutsf = nutsf.join(color, how="left").fillna(0)
         color = "quantity_tn"
 
-    nutsff = nutsf.loc[sel_nuts or slice(None)]
-    fig_nuts = px.choropleth_mapbox(
-        nutsff, geojson=nutsff.geometry, locations=nutsff.index, color=color
-    )
-    fig_nuts.update_traces(
-        dict(marker=dict(line=dict(color="rgb(247, 150, 70)", width=3)))
-    )
+    # The outlines are fetched once by the browser, see src.geometry
+    nutsf = nutsf.reset_index()
+    nutsff = nutsf.set_index("id", drop=False)
+    if sel_nuts:
+        # Unknown NUTS are ignored, like in ODTensor.nuts_codes
+        nutsff = nutsff.loc[nutsff.index.intersection(sel_nuts)]
 
     fig = px.choropleth_mapbox(
         nutsf,
-        geojson=nutsf.geometry,
-        locations=nutsf.index,
+        geojson=geojson_url(),
+        featureidkey="id",
+        locations="id",
         color=color,
-        center=center,
+        center=center(),
         # fitbounds="geojson",
         zoom=5,
         mapbox_style="carto-positron",
     )
 
-    fig.add_trace(fig_nuts.data[0])
+    # The selection is outlined, unless none of it is known
+    if len(nutsff):
+        fig_nuts = px.choropleth_mapbox(
+            nutsff,
+            geojson=geojson_url(),
+            featureidkey="id",
+            locations="id",
+            color=color,
+        )
+        fig_nuts.update_traces(
+            dict(marker=dict(line=dict(color="rgb(247, 150, 70)", width=3)))
+        )
+        fig.add_trace(fig_nuts.data[0])
 
     return fig
 
 
-@callback(
-    Output("distr-barchart", "figure"),
-    Input("input-update", "n_clicks"),
-    State("input-direction", "value"),
-    State("input-nuts", "value"),
-    State("input-products", "value"),
-)
-def update_barchart(click, direction, sel_nuts, products):
-    cols = ["product_name", "origin_nuts", "destination_nuts"]
-    odsf = ods.loc[products or slice(None)].groupby(cols).sum()
-    dfs = []
-    for s in sel_nuts or []:
-        try:
-            df = odsf.xs(s, level=f"{direction}_nuts")
-            dfs.append(df)
-        except KeyError:
-            pass
+def update_barchart(flows):
+    nuts = store[projection("nuts", "NUTS_NAME")]
 
-    if dfs:
-        df = pd.concat(dfs)
-        df = df.groupby(list(df.index.names)).sum().squeeze().reset_index()
-        nutscol = [c for c in df.columns if "_nuts" in c][0]
+    if flows is not None:
+        nutscol = flows.columns.name
+        df = flows.stack().rename("quantity_tn").reset_index()
+        df = df[df["quantity_tn"] != 0]
         df = rename_nuts(nuts, df, [nutscol], trim_len=15)
         fig = px.bar(
             df.sort_values("quantity_tn", ascending=False),
@@ -264,20 +364,29 @@ def update_barchart(click, direction, sel_nuts, products):
         return dash.no_update
 
 
-@callback(
-    Output("distr-heatmap", "figure"),
-    Input("input-update", "n_clicks"),
-    State("input-products", "value"),
-)
-def update_heatmap(click, products):
-    thresh = 20
+def heatmap_table(ods, products=None):
+    """Origin x destination quantities by NUTS name, in the form read by the browser."""
+    nuts = store[projection("nuts", "NUTS_NAME")]
     cols = ["origin_nuts", "destination_nuts"]
-    df = ods.loc[products or slice(None)].groupby(cols).sum().reset_index()
+    df = ods.matrix(products).stack().rename("quantity_tn")
+    df = df.reset_index()
     df = rename_nuts(nuts, df, cols, trim_len=15)
-    df = df.groupby(cols).sum().squeeze()
-    df = df[df > thresh].unstack()
-    fig = px.imshow(df)
-    return fig
+    df = df.groupby(cols, observed=True).sum().squeeze().unstack()
+    values = df.to_numpy()
+    return {
+        "x": df.columns.tolist(),
+        "y": df.index.tolist(),
+        "z": np.where(np.isnan(values), None, values).tolist(),
+    }
+
+
+clientside_callback(
+    ClientsideFunction(namespace="agro", function_name="heatmap"),
+    Output("distr-heatmap", "figure"),
+    Input("distr-od", "data"),
+    Input("input-heatmap-thresh", "value"),
+    State("figure-template", "data"),
+)
 
 
 # @callback(
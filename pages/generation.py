@@ -1,10 +1,14 @@
-import pandas as pd
-import geopandas as gpd
 import plotly.express as px
 import dash
-from dash import html, dcc, callback, Input, Output, State
+from dash import html, dcc, callback, clientside_callback, ClientsideFunction
+from dash import Input, Output, State
 import dash_bootstrap_components as dbc
-from src.io import fetch_data
+from src.io import projection, store
+from src.cache import memoize
+from src.metrics import instrument, stage
+from src.aggregates import cube_name, month_range, slice_cube
+from src.geometry import center, geojson_url
+from src.utils import rename_nuts
 
 # dash.register_page(__name__)
 descr = "Παραγωγή/Κατανάλωση"
@@ -18,16 +22,8 @@ dash.register_page(
 )
 
 
-data = fetch_data()
-nuts = data["nuts"]
-distr = data["distr"]
-prods = data["prods"]
-cons = data["cons"]
-
-nuts = nuts[(nuts["LEVL_CODE"] == 3) & (nuts["CNTR_CODE"] == "EL")]
-
-
 def layout():
+    nuts = store["nuts3"]
 
     controls = dbc.Card(
         [
@@ -61,9 +57,10 @@ def layout():
                                     dbc.Select(
                                         id="input-year",
                                         options=[
-                                            {"label": "2018", "value": 2018},
+                                            {"label": str(year), "value": year}
+                                            for year in store.years()
                                         ],
-                                        value=2018,
+                                        value=store.years()[-1],
                                     ),
                                 ],
                                 width=2,
@@ -174,9 +171,24 @@ def layout():
                                                     inline=True,
                                                     id="input-graph-type",
                                                 ),
+                                                dbc.Checklist(
+                                                    options=[
+                                                        {
+                                                            "label": "Ταξινόμηση",
+                                                            "value": "sort",
+                                                        }
+                                                    ],
+                                                    value=[],
+                                                    switch=True,
+                                                    inline=True,
+                                                    id="input-graph-sort",
+                                                ),
                                             ]
                                         ),
                                         dbc.Row(dcc.Graph(id="gen-graph")),
+                                        # Aggregates of the last update, drawn
+                                        # by the clientside callback below
+                                        dcc.Store(id="gen-data"),
                                     ],
                                     width=8,
                                 ),
@@ -202,16 +214,15 @@ def layout():
 @callback(Output("input-products", "options"), Input("input-products-type", "value"))
 def change_products_type(products_type):
     if products_type:
-        return prods.index.unique(products_type)
+        return store["products"].unique(products_type)
     else:
         return dash.no_update
 
 
 @callback(
-    Output("gen-graph", "figure"),
     Output("gen-map", "figure"),
+    Output("gen-data", "data"),
     Input("input-update", "n_clicks"),
-    Input("input-graph-type", "value"),
     State("input-direction", "value"),
     State("input-year", "value"),
     State("input-months", "value"),
@@ -219,63 +230,71 @@ def change_products_type(products_type):
     State("input-products-type", "value"),
     State("input-products", "value"),
 )
-def update_view(
-    n, graph_type, direction, year, months, sel_nuts, products_type, products
-):
-
-    if direction == "production":
-        df = prods.copy()
-    else:
-        df = cons.copy()
+@instrument
+@memoize(ignore=["n"])
+def update_view(n, direction, year, months, sel_nuts, products_type, products):
+    with stage("aggregate") as st:
+        start, end = month_range(year, months)
+        df = slice_cube(
+            store[cube_name(direction, products_type, year)],
+            start,
+            end,
+            sel_nuts,
+            products,
+        )
+        df_map = df.groupby("nuts", observed=True).sum()
+        st.rows = len(df)
 
-    df = (
-        df.groupby(["date", "nuts", products_type])
-        .sum()
-        .loc[
-            f"{year}-{months[0]}-1":f"{year}-{months[1]}-28",
-            sel_nuts or slice(None),
-            products or slice(None),
-        ]
-    )
-
-    df_map = df.groupby("nuts").sum()
-    nutsf = pd.merge(
-        df_map,
-        nuts.rename_axis(index={"id": "nuts"}).geometry,
-        left_index=True,
-        right_index=True,
-        how="left",
-    )
-
-    nutsf = gpd.GeoDataFrame(nutsf, geometry=nutsf.geometry)
-    # nutsf = nuts.loc[prodsf.index.unique("nuts")]
-    bbox = nutsf.total_bounds
-    center = {"lat": (bbox[1] + bbox[3]) / 2, "lon": (bbox[0] + bbox[2]) / 2}
+    with stage("map"):
+        # The outlines are fetched once by the browser, see src.geometry
+        map = px.choropleth_mapbox(
+            df_map.reset_index(),
+            geojson=geojson_url(),
+            featureidkey="id",
+            locations="nuts",
+            color="quantity_tn",
+            center=center(df_map.index),
+            zoom=5,
+            mapbox_style="carto-positron",
+        )
 
-    map = px.choropleth_mapbox(
-        nutsf,
-        geojson=nutsf.geometry,
-        locations=nutsf.index,
-        color="quantity_tn",
-        center=center,
-        zoom=5,
-        mapbox_style="carto-positron",
-    )
+    with stage("graph") as st:
+        data = {
+            "products_type": products_type,
+            "date": graph_table(df, "date", products_type),
+            "nuts": graph_table(df, "nuts", products_type),
+        }
+        st.rows = len(data["date"]["index"]) + len(data["nuts"]["index"])
 
-    dfp = df.groupby([graph_type, products_type]).sum().reset_index()
+    return map, data
 
-    if graph_type == "nuts":
-        dfp["nuts"] = dfp["nuts"].replace(nuts["NUTS_NAME"].to_dict()).str[0:20]
 
-    graph = px.bar(
-        dfp,
-        x=graph_type,
-        y="quantity_tn",
-        color=products_type,
-    )
+def graph_table(df, by, products_type):
+    """Quantities by ``by`` x product, in the columnar form read by the browser."""
+    table = df.groupby([by, products_type], observed=True)["quantity_tn"].sum()
+    table = table.unstack(fill_value=0)
+    if by == "nuts":
+        labels = rename_nuts(
+            store[projection("nuts3", "NUTS_NAME")],
+            table.index.to_frame(),
+            ["nuts"],
+            20,
+        )
+        index = labels["nuts"].tolist()
+    else:
+        index = table.index.strftime("%Y-%m-%d").tolist()
+    return {
+        "index": index,
+        "columns": table.columns.tolist(),
+        "values": table.to_numpy().tolist(),
+    }
 
-    graph.update_layout(
-        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
-    )
 
-    return graph, map
+clientside_callback(
+    ClientsideFunction(namespace="agro", function_name="generationGraph"),
+    Output("gen-graph", "figure"),
+    Input("gen-data", "data"),
+    Input("input-graph-type", "value"),
+    Input("input-graph-sort", "value"),
+    State("figure-template", "data"),
+)
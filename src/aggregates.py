@@ -0,0 +1,125 @@
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from src.io import partition, store
+
+DIRECTIONS = {"production": "prods", "consumption": "cons"}
+PRODUCT_LEVELS = ("product_group", "product_name")
+
+
+def cube_name(direction, products_type, year=None):
+    return partition(f"cube:{direction}:{products_type}", year)
+
+
+def build_cube(store, dataset, products_type, year=None):
+    # Sorted (date, nuts, product) index, so that filters are index slices
+    df = store[partition(dataset, year)]
+    return df.groupby(["date", "nuts", products_type], observed=True).sum().sort_index()
+
+
+for _direction, _dataset in DIRECTIONS.items():
+    for _level in PRODUCT_LEVELS:
+        store.derive(cube_name(_direction, _level))(
+            partial(build_cube, dataset=_dataset, products_type=_level)
+        )
+
+
+def month_range(year, months):
+    """First day of the first month and of the month after the last one."""
+    start = pd.Timestamp(year=int(year), month=int(months[0]), day=1)
+    end = pd.Timestamp(year=int(year), month=int(months[1]), day=1)
+    return start, end + pd.offsets.MonthBegin()
+
+
+def slice_cube(cube, start, end, sel_nuts=None, products=None):
+    """Rows of ``cube`` dated in [start, end) and in the selection."""
+    # The dates are the outer level of a sorted index: locate the range by
+    # binary search on the level, then on the row codes of the level
+    dates = cube.index.levels[0].searchsorted([start, end])
+    first, last = np.searchsorted(cube.index.codes[0], dates)
+    cube = cube.iloc[first:last]
+    if sel_nuts or products:
+        cube = cube.loc[
+            (slice(None), sel_nuts or slice(None), products or slice(None)), :
+        ]
+    return cube
+
+
+class ODTensor:
+    """Dense product x origin x destination OD matrix with label lookups."""
+
+    def __init__(self, values, products, nuts):
+        self.values = values
+        self.products = products
+        self.nuts = nuts
+
+    @classmethod
+    def from_series(cls, ods):
+        cols = ["product_name", "origin_nuts", "destination_nuts"]
+        ods = ods.groupby(cols, observed=True).sum()
+        products = ods.index.unique("product_name").sort_values()
+        nuts = (
+            ods.index.unique("origin_nuts")
+            .union(ods.index.unique("destination_nuts"))
+            .rename("id")
+        )
+
+        values = np.zeros((len(products), len(nuts), len(nuts)))
+        values[
+            products.get_indexer(ods.index.get_level_values("product_name")),
+            nuts.get_indexer(ods.index.get_level_values("origin_nuts")),
+            nuts.get_indexer(ods.index.get_level_values("destination_nuts")),
+        ] = ods.to_numpy()
+        return cls(values, products, nuts)
+
+    def product_codes(self, products=None):
+        if not products:
+            return np.arange(len(self.products))
+        codes = self.products.get_indexer(products)
+        return codes[codes >= 0]
+
+    def nuts_codes(self, sel_nuts):
+        codes = self.nuts.get_indexer(sel_nuts or [])
+        return codes[codes >= 0]
+
+    def matrix(self, products=None):
+        """Origin x destination frame summed over the selected products."""
+        return pd.DataFrame(
+            self.values[self.product_codes(products)].sum(axis=0),
+            index=self.nuts.rename("origin_nuts"),
+            columns=self.nuts.rename("destination_nuts"),
+        )
+
+    def flows(self, direction, sel_nuts, products=None):
+        """Products x NUTS flows from (origin) or to (destination) ``sel_nuts``.
+
+        Returns None when none of ``sel_nuts`` is known.
+        """
+        codes = self.nuts_codes(sel_nuts)
+        if not len(codes):
+            return None
+        axis = 1 if direction == "origin" else 2
+        other = "destination" if direction == "origin" else "origin"
+        products = self.product_codes(products)
+        values = self.values.take(codes, axis=axis)[products]
+        return pd.DataFrame(
+            values.sum(axis=axis),
+            index=self.products[products],
+            columns=self.nuts.rename(f"{other}_nuts"),
+        )
+
+
+@store.derive("od_tensor")
+def build_od_tensor(store, year=None):
+    return ODTensor.from_series(store[partition("ods", year)])
+
+
+def od_tensor(year=None):
+    """OD tensor of the year, shared by every request.
+
+    Selections are passed to ``flows`` and ``matrix`` as products, rather
+    than held as tensors of their own.
+    """
+    return store[partition("od_tensor", int(year) if year else None)]
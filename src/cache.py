@@ -0,0 +1,143 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import diskcache
+
+from src.io import store
+from src.jobs import JOBS_DIR
+from src.metrics import CACHE_REQUESTS
+
+CACHE_DIR = os.environ.get("AGRO_CACHE_DIR")
+CACHE_SIZE = int(os.environ.get("AGRO_CACHE_SIZE", 256 * 2**20))
+CACHE_TTL = float(os.environ.get("AGRO_CACHE_TTL", 0)) or None
+
+
+class MemoryCache:
+    """Size-bounded, in-process LRU cache of pickled values."""
+
+    def __init__(self, size_limit=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size_limit = size_limit
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                return None
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.size_limit:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires)
+            self.size += len(value)
+            while self.size > self.size_limit:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self.size -= len(value)
+
+
+class DiskCache:
+    """LRU cache on local disk, shared by all the workers of a host."""
+
+    def __init__(self, directory, size_limit=CACHE_SIZE, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.handle = diskcache.Cache(
+            directory,
+            size_limit=size_limit,
+            eviction_policy="least-recently-used",
+        )
+
+    def get(self, key):
+        return self.handle.get(key)
+
+    def set(self, key, value):
+        self.handle.set(key, value, expire=self.ttl)
+
+
+backend = DiskCache(CACHE_DIR) if CACHE_DIR else MemoryCache()
+# Long callbacks run in forked jobs (see src.jobs), whose memory dies with
+# them: their results are always kept on disk
+job_backend = backend if CACHE_DIR else DiskCache(os.path.join(JOBS_DIR, "memoize"))
+
+
+def normalize(value):
+    """Make equivalent callback inputs hash the same.
+
+    Empty selections mean "everything" in every callback, and the order of
+    the items of a multi-select does not change the selection.
+    """
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return None
+        if all(isinstance(v, str) for v in value):
+            return tuple(sorted(value))
+        return tuple(normalize(v) for v in value)
+    return value
+
+
+def plain(result):
+    """Figures as plain dicts, which unpickle much faster than plotly objects."""
+    if isinstance(result, tuple):
+        return tuple(plain(r) for r in result)
+    if hasattr(result, "to_plotly_json"):
+        return result.to_plotly_json()
+    return result
+
+
+def cache_key(name, arguments):
+    items = sorted((k, normalize(v)) for k, v in arguments.items())
+    return hashlib.sha1(repr((name, store.version, items)).encode()).hexdigest()
+
+
+def memoize(ignore=(), job=False):
+    """Cache the results of a callback, keyed on its normalized arguments.
+
+    Arguments listed in ``ignore`` (e.g. ``n_clicks``) are left out of the key.
+    ``job`` callbacks run in forked jobs and are cached in ``job_backend``.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        cache = job_backend if job else backend
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {k: v for k, v in bound.arguments.items() if k not in ignore}
+            key = cache_key(name, arguments)
+
+            value = cache.get(key)
+            CACHE_REQUESTS.labels(name, "hits" if value is not None else "misses").inc()
+            if value is not None:
+                return pickle.loads(value)
+
+            result = plain(func(*args, **kwargs))
+            cache.set(key, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+            return result
+
+        return wrapper
+
+    return decorator
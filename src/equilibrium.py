@@ -0,0 +1,220 @@
+import re
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csgraph
+
+from src.io import partition, store
+from src.network import lookup, selection_mask
+
+# BPR link cost, t0 * (1 + ALPHA * (volume / capacity) ** BETA)
+ALPHA = 0.15
+BETA = 4
+# Free flow speed (km/h) and capacity per lane (tn over the assignment
+# period, i.e. a year of ODs) by OSM highway class, when the link has no
+# maxspeed or lanes of its own
+SPEEDS = {
+    "motorway": 110,
+    "trunk": 90,
+    "primary": 70,
+    "secondary": 60,
+    "tertiary": 50,
+}
+CAPACITIES = {
+    "motorway": 4e6,
+    "trunk": 3e6,
+    "primary": 2e6,
+    "secondary": 1.2e6,
+    "tertiary": 8e5,
+}
+DEFAULT_SPEED = 40
+DEFAULT_CAPACITY = 5e5
+LANES = {"motorway": 2, "trunk": 2}
+
+MAX_ITERATIONS = 50
+TIME_LIMIT = 10
+# Target relative gap
+GAP = 1e-4
+# Bisection steps of the Frank-Wolfe line search
+LINE_SEARCH = 30
+
+
+def number(value, default):
+    """First number of an OSM tag value ("50", "50 mph", ["2", "3"], None)."""
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    match = re.search(r"\d+(\.\d+)?", str(value)) if value is not None else None
+    return float(match.group()) if match else default
+
+
+def highway_class(highway):
+    if isinstance(highway, (list, tuple)):
+        highway = highway[0] if highway else None
+    # Link roads (motorway_link etc.) are taken as their road
+    return str(highway).replace("_link", "")
+
+
+class BPRLinks:
+    """Free flow times and capacities of the links of a PathEngine."""
+
+    def __init__(self, free_flow, capacity):
+        self.free_flow = free_flow
+        self.capacity = capacity
+
+    @classmethod
+    def from_engine(cls, engine):
+        links = engine.links
+        highway = links["highway"].map(highway_class)
+        speed = [
+            number(maxspeed, SPEEDS.get(h, DEFAULT_SPEED))
+            for maxspeed, h in zip(links["maxspeed"], highway)
+        ]
+        lanes = [number(n, LANES.get(h, 1)) for n, h in zip(links["lanes"], highway)]
+        capacity = highway.map(CAPACITIES).fillna(DEFAULT_CAPACITY) * lanes
+        # Length in m, speed in km/h: free flow time in h
+        free_flow = links["length"].to_numpy(dtype="float64") / 1000 / np.array(speed)
+        return cls(free_flow, capacity.to_numpy(dtype="float64"))
+
+    def costs(self, volumes):
+        return self.free_flow * (1 + ALPHA * (volumes / self.capacity) ** BETA)
+
+    def objective_slope(self, volumes, direction, step):
+        """Derivative of the Beckmann objective along ``direction`` at ``step``."""
+        return np.dot(direction, self.costs(volumes + step * direction))
+
+
+class Demand:
+    """OD volumes between network nodes, grouped by source node."""
+
+    def __init__(self, sources, rows, targets, volumes):
+        self.sources = sources
+        self.rows = rows
+        self.targets = targets
+        self.volumes = volumes
+
+    @classmethod
+    def from_ods(cls, odsf, osmids, nodes):
+        """Sum OD volumes (origin_nuts, destination_nuts) onto node position pairs."""
+        src = nodes.get_indexer(lookup(osmids, odsf.index.get_level_values(0)))
+        tgt = nodes.get_indexer(lookup(osmids, odsf.index.get_level_values(1)))
+        valid = (src >= 0) & (tgt >= 0) & (src != tgt)
+        pairs = (
+            pd.Series(odsf.to_numpy()[valid]).groupby([src[valid], tgt[valid]]).sum()
+        )
+        pairs = pairs[pairs > 0]
+        src = pairs.index.get_level_values(0).to_numpy()
+        sources, rows = np.unique(src, return_inverse=True)
+        return cls(
+            sources,
+            rows,
+            pairs.index.get_level_values(1).to_numpy(),
+            pairs.to_numpy(),
+        )
+
+
+def all_or_nothing(engine, demand, costs):
+    """Link volumes of the demand loaded on the shortest paths at ``costs``.
+
+    Returns the volumes and the total cost of the shortest paths.
+    """
+    distances, predecessors = csgraph.dijkstra(
+        engine.weighted(costs), indices=demand.sources, return_predecessors=True
+    )
+    distances = distances[demand.rows, demand.targets]
+    reached = np.isfinite(distances)
+    rows, nodes = demand.rows[reached], demand.targets[reached]
+    weights = demand.volumes[reached]
+
+    # Walk all the paths back to their sources at once, one link per step
+    volumes = np.zeros(len(engine.links))
+    while len(nodes):
+        previous = predecessors[rows, nodes]
+        volumes += np.bincount(
+            engine.link_positions(previous, nodes),
+            weights=weights,
+            minlength=len(volumes),
+        )
+        walking = previous != demand.sources[rows]
+        rows, nodes, weights = rows[walking], previous[walking], weights[walking]
+    return volumes, np.dot(distances[reached], demand.volumes[reached])
+
+
+def line_search(links, volumes, direction):
+    """Step in [0, 1] minimizing the Beckmann objective, by bisection."""
+    if links.objective_slope(volumes, direction, 1) <= 0:
+        return 1.0
+    low, high = 0.0, 1.0
+    for _ in range(LINE_SEARCH):
+        step = (low + high) / 2
+        if links.objective_slope(volumes, direction, step) < 0:
+            low = step
+        else:
+            high = step
+    return (low + high) / 2
+
+
+def equilibrium(
+    demand,
+    method="fw",
+    max_iterations=MAX_ITERATIONS,
+    time_limit=TIME_LIMIT,
+    gap=GAP,
+    progress=None,
+):
+    """User equilibrium link volumes under BPR costs.
+
+    Frank-Wolfe (``"fw"``) or the method of successive averages (``"msa"``)
+    from an all-or-nothing loading at free flow. Stops at ``max_iterations``,
+    after ``time_limit`` seconds or once the relative gap is below ``gap``.
+    Returns the volumes, aligned to the links of the path engine, and the
+    relative gap of every iteration.
+    """
+    engine = store["path_engine"]
+    links = store["bpr_links"]
+    start = time.perf_counter()
+
+    volumes, _ = all_or_nothing(engine, demand, links.free_flow)
+    gaps = []
+    for iteration in range(1, max_iterations + 1):
+        costs = links.costs(volumes)
+        target, shortest = all_or_nothing(engine, demand, costs)
+        total = np.dot(costs, volumes)
+        gaps.append(float((total - shortest) / total) if total > 0 else 0.0)
+        if progress:
+            progress(iteration, gaps[-1])
+        if gaps[-1] < gap or time.perf_counter() - start > time_limit:
+            break
+
+        direction = target - volumes
+        if method == "msa":
+            step = 1 / (iteration + 1)
+        else:
+            step = line_search(links, volumes, direction)
+        volumes = volumes + step * direction
+    return volumes, gaps
+
+
+def link_volumes(volumes):
+    """Volumes of the path engine links summed by osmid."""
+    osmids = store["path_engine"].links["osmid"].to_numpy()
+    volumes = pd.Series(volumes, name="volume").groupby(osmids).sum()
+    return volumes.rename_axis("osmid")
+
+
+def assign_equilibrium(products=None, origins=None, year=None, **kwargs):
+    """Equilibrium link volumes (by osmid) of the selected ODs and the gaps.
+
+    See ``equilibrium`` for the keyword arguments.
+    """
+    ods = store[partition("ods", year)]
+    odsf = ods[selection_mask(ods.index, products, origins)]
+    odsf = odsf.groupby(["origin_nuts", "destination_nuts"], observed=True).sum()
+    demand = Demand.from_ods(odsf, store["nuts3"]["osmid"], store["path_engine"].nodes)
+    volumes, gaps = equilibrium(demand, **kwargs)
+    return link_volumes(volumes), gaps
+
+
+@store.derive("bpr_links")
+def build_bpr_links(store):
+    return BPRLinks.from_engine(store["path_engine"])
@@ -0,0 +1,171 @@
+import hashlib
+import json
+
+import flask
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import mapping
+from shapely.ops import transform
+
+from src.io import store
+
+# In the units of epsgs["proj"] (metres)
+LINK_TOLERANCE = 50
+LINK_BUFFER = 2000
+NUTS_TOLERANCE = 500
+# Decimal places kept of the coordinates sent to the browser (~1 m)
+PRECISION = 5
+# Region outlines are drawn at country scale (~10 m)
+NUTS_PRECISION = 4
+GEOJSON_URL = "/geojson/{name}.json"
+
+
+class LinkLines:
+    """Flat lon/lat arrays of the link geometries, separated by NaN gaps.
+
+    The points of link ``i`` (and its trailing gap) are
+    ``lon[offsets[i]:offsets[i + 1]]``, so that the lines of any set of links
+    can be gathered into a single mapbox trace without touching geometries.
+    """
+
+    def __init__(self, index, offsets, lon, lat):
+        self.index = index
+        self.offsets = offsets
+        self.lon = lon
+        self.lat = lat
+
+    @classmethod
+    def from_geoseries(cls, geometries):
+        lon, lat, counts = [], [], []
+        for geometry in geometries:
+            parts = getattr(geometry, "geoms", [geometry])
+            count = 0
+            for part in parts:
+                x, y = part.xy
+                lon += [*x, np.nan]
+                lat += [*y, np.nan]
+                count += len(x) + 1
+            counts.append(count)
+
+        offsets = np.r_[0, np.cumsum(counts)]
+        return cls(
+            geometries.index,
+            offsets,
+            np.round(lon, PRECISION),
+            np.round(lat, PRECISION),
+        )
+
+    def coordinates(self, osmids, ids=False):
+        """Lon and lat of the points of ``osmids`` and, with ``ids``, their link."""
+        positions = self.index.get_indexer_for(osmids)
+        positions = positions[positions >= 0]
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        # Positions of the points of every selected link, back to back
+        shift = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+        points = shift + np.arange(lengths.sum())
+        if ids:
+            links = np.repeat(self.index.to_numpy()[positions], lengths)
+            return self.lon[points], self.lat[points], links
+        return self.lon[points], self.lat[points]
+
+    def midpoints(self, osmids):
+        """Lon, lat and osmid of a middle point of every link of ``osmids``."""
+        positions = self.index.get_indexer_for(osmids)
+        positions = positions[positions >= 0]
+        starts = self.offsets[positions]
+        middle = starts + (self.offsets[positions + 1] - starts - 2) // 2
+        # On the gap between two parts of a link, take the point before it
+        middle -= np.isnan(self.lon[middle])
+        return self.lon[middle], self.lat[middle], self.index.to_numpy()[positions]
+
+
+def volume_classes(vols, bins=5):
+    """Quantile class edges of the link volumes and the class of every link."""
+    edges = (
+        np.unique(np.quantile(vols, np.linspace(0, 1, bins + 1))) if len(vols) else []
+    )
+    if len(edges) == 1:
+        edges = np.repeat(edges, 2)
+    return edges, np.digitize(vols, edges[1:-1])
+
+
+def simplified_links(store):
+    epsgs = store["epsgs"]
+    links = store["links"].set_index("osmid")
+    geometries = gpd.GeoSeries(links.geometry, crs=links.crs or epsgs["world"])
+    return geometries.to_crs(epsg=epsgs["proj"]).simplify(LINK_TOLERANCE)
+
+
+@store.derive("link_lines")
+def build_link_lines(store):
+    lines = simplified_links(store).to_crs(epsg=store["epsgs"]["world"])
+    return LinkLines.from_geoseries(lines)
+
+
+@store.derive("link_polygons")
+def build_link_polygons(store):
+    polygons = simplified_links(store).buffer(LINK_BUFFER)
+    polygons = polygons.simplify(LINK_TOLERANCE).to_crs(epsg=store["epsgs"]["world"])
+    return polygons.rename("geometry")
+
+
+def quantize(geometry, precision):
+    return transform(
+        lambda x, y: (np.round(x, precision), np.round(y, precision)), geometry
+    )
+
+
+@store.derive("nuts_geojson")
+def build_nuts_geojson(store):
+    """The NUTS3 outlines as serialized GeoJSON, feature ids are the NUTS ids."""
+    epsgs = store["epsgs"]
+    nuts = store["nuts3"]
+    geometries = nuts.geometry.to_crs(epsg=epsgs["proj"]).simplify(NUTS_TOLERANCE)
+    geometries = geometries.to_crs(epsg=epsgs["world"])
+    features = [
+        {
+            "type": "Feature",
+            "id": id,
+            "properties": {},
+            "geometry": mapping(quantize(geometry, NUTS_PRECISION)),
+        }
+        for id, geometry in geometries.items()
+    ]
+    collection = {"type": "FeatureCollection", "features": features}
+    return json.dumps(collection, separators=(",", ":")).encode()
+
+
+@store.derive("nuts_bounds")
+def build_nuts_bounds(store):
+    return store["nuts3"].bounds
+
+
+def geojson_url(name="nuts3"):
+    return GEOJSON_URL.format(name=name)
+
+
+def center(nuts=None):
+    """Centre of the bounding box of the ``nuts`` regions (all by default)."""
+    bounds = store["nuts_bounds"]
+    if nuts is not None:
+        bounds = bounds.loc[bounds.index.intersection(nuts)]
+    return {
+        "lat": (bounds["miny"].min() + bounds["maxy"].max()) / 2,
+        "lon": (bounds["minx"].min() + bounds["maxx"].max()) / 2,
+    }
+
+
+def geojson(name):
+    if name != "nuts3":
+        flask.abort(404)
+    data = store["nuts_geojson"]
+    response = flask.Response(data, mimetype="application/geo+json")
+    response.set_etag(hashlib.sha1(data).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(flask.request)
+
+
+def init_app(server):
+    server.add_url_rule(GEOJSON_URL.format(name="<name>"), "geojson", geojson)
@@ -0,0 +1,131 @@
+import logging
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csgraph
+
+from src import paths  # noqa: F401, registers the path engine
+from src.aggregates import ODTensor
+from src.io import partition, store
+
+# Deterrence functions of the generalized cost (road km) and their default
+# parameter
+DETERRENCE = {
+    "exponential": lambda costs, beta: np.exp(-beta * costs),
+    "power": lambda costs, beta: costs**-beta,
+}
+BETAS = {"exponential": 0.01, "power": 2.0}
+# Furness stops once the origin totals are off by less than this (relative)
+TOLERANCE = 1e-4
+MAX_ITERATIONS = 200
+# Models kept per process, each as large as the observed OD tensor
+CACHE_SIZE = 4
+
+logger = logging.getLogger(__name__)
+
+
+@store.derive("nuts_costs")
+def build_nuts_costs(store):
+    """NUTS3 x NUTS3 road distances (km) between the NUTS nodes of ``net``.
+
+    The intrazonal distance is half the distance to the nearest region;
+    regions without a node are infinitely far.
+    """
+    engine = store["path_engine"]
+    nuts = store["nuts3"]
+    nodes = engine.nodes.get_indexer(nuts["osmid"])
+    known = np.flatnonzero(nodes >= 0)
+
+    costs = np.full((len(nuts), len(nuts)), np.inf)
+    distances = csgraph.dijkstra(engine.graph, indices=nodes[known])
+    costs[np.ix_(known, known)] = distances[:, nodes[known]] / 1000
+    np.fill_diagonal(costs, np.inf)
+    np.fill_diagonal(costs, costs.min(axis=1) / 2)
+    return pd.DataFrame(costs, index=nuts.index, columns=nuts.index)
+
+
+def totals(dataset, year, nuts):
+    """Products x NUTS quantities of ``dataset`` over the year."""
+    df = store[partition(dataset, year)]["quantity_tn"]
+    df = df.groupby(["product_name", "nuts"], observed=True).sum().unstack()
+    return df.reindex(columns=nuts).fillna(0)
+
+
+def furness(
+    origins, destinations, weights, tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS
+):
+    """Doubly constrained flows of every product, balanced by Furness.
+
+    ``origins`` and ``destinations`` are products x zones totals, ``weights``
+    the zones x zones deterrence. The flows are ``a * origins * weights * b
+    * destinations`` and only the balancing factors are iterated, all
+    products at once. Returns the products x origins x destinations flows,
+    the iterations run and the remaining relative error.
+    """
+    # Destination totals are scaled to the origin totals of their product
+    scale = np.divide(
+        origins.sum(axis=1),
+        destinations.sum(axis=1),
+        out=np.zeros(len(origins)),
+        where=destinations.sum(axis=1) > 0,
+    )
+    destinations = destinations * scale[:, None]
+
+    b = np.ones_like(destinations)
+    for iteration in range(1, max_iterations + 1):
+        rows = (b * destinations) @ weights.T
+        a = np.divide(1, rows, out=np.zeros_like(rows), where=rows > 0)
+        cols = (a * origins) @ weights
+        b = np.divide(1, cols, out=np.zeros_like(cols), where=cols > 0)
+        # The destination totals hold after every step, check the origins
+        produced = a * origins * ((b * destinations) @ weights.T)
+        error = np.abs(produced - origins).sum() / max(origins.sum(), 1e-12)
+        if error < tolerance:
+            break
+
+    flows = (a * origins)[:, :, None] * weights[None] * (b * destinations)[:, None, :]
+    return flows, iteration, error
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def gravity_ods(
+    version, year=None, function="exponential", beta=None, tolerance=TOLERANCE
+):
+    """OD tensor of a gravity model of the year's production and consumption.
+
+    ``version`` is the ``store.version`` the model is cached for.
+    """
+    costs = store["nuts_costs"]
+    nuts = costs.index
+    origins = totals("prods", year, nuts)
+    destinations = totals("cons", year, nuts)
+    products = origins.index.union(destinations.index).sort_values()
+
+    beta = BETAS[function] if beta is None else beta
+    # Regions sharing a node are 1 m apart, unreachable ones get no flow
+    with np.errstate(over="ignore"):
+        weights = DETERRENCE[function](np.maximum(costs.to_numpy(), 1e-3), beta)
+    values, iterations, error = furness(
+        origins.reindex(products, fill_value=0).to_numpy(),
+        destinations.reindex(products, fill_value=0).to_numpy(),
+        np.nan_to_num(weights),
+        tolerance,
+    )
+    logger.info(
+        "gravity %s(%s) for %s: %d iterations, error %.1e",
+        function,
+        beta,
+        year,
+        iterations,
+        error,
+    )
+    return ODTensor(values, products, nuts.rename("id"))
+
+
+def gravity_tensor(year=None, function="exponential", beta=None, tolerance=None):
+    """Like ``src.aggregates.od_tensor``, from the gravity model."""
+    year = int(year) if year else None
+    beta = float(beta) if beta not in (None, "") else None
+    tolerance = float(tolerance) if tolerance not in (None, "") else TOLERANCE
+    return gravity_ods(store.version, year, function, beta, tolerance)
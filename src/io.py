@@ -1,7 +1,491 @@
+import argparse
+import json
+import logging
+import os
 import pickle
+import sys
+import threading
+import time
 
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+from scipy import sparse
 
-def fetch_data():
-    with open("./assets/data.pkl", "rb") as handle:
+DATA_PATH = "./assets/data.pkl"
+DATA_DIR = "./assets/data"
+MANIFEST = "manifest.json"
+# Manifest entry of the derived datasets written by src.precompute
+DERIVED = "derived"
+DATASETS = ("nuts", "distr", "prods", "cons", "ods", "net", "links", "spaths", "epsgs")
+# Input recorded by the loads that list the years of a dataset, as
+# "__years__:<name>" (see DataStore.years)
+YEARS = "__years__:"
+# Written one file per year, and loaded per year as "<name>:<year>"
+PARTITIONED = ("prods", "cons", "ods")
+# Index levels of the datasets in PARTITIONED that share a categorical dtype
+KEYS = {
+    "nuts": "nuts",
+    "origin_nuts": "nuts",
+    "destination_nuts": "nuts",
+    "product_group": "product_group",
+    "product_name": "product_name",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_data(path=DATA_PATH):
+    with open(path, "rb") as handle:
         data = pickle.load(handle)
         return data
+
+
+def default_path():
+    path = os.environ.get("AGRO_DATA")
+    if path:
+        return path
+    return DATA_DIR if os.path.isdir(DATA_DIR) else DATA_PATH
+
+
+def partition(name, year=None):
+    return name if year is None else f"{name}:{int(year)}"
+
+
+def projection(name, *columns):
+    """Name of ``name`` restricted to ``columns``, as in "nuts[NUTS_NAME]".
+
+    Only those columns are read from the Arrow file of the dataset, e.g.
+    without decoding its geometries.
+    """
+    return f"{name}[{','.join(columns)}]"
+
+
+def index_years(obj):
+    """Year of every row of a dataset, None if it is not dated."""
+    if "date" in obj.index.names:
+        return obj.index.get_level_values("date").year
+    if "year" in obj.index.names:
+        return obj.index.get_level_values("year")
+    return None
+
+
+def year_rows(obj, year):
+    """Rows of ``year``, or all of them if the dataset is not dated."""
+    years = index_years(obj)
+    if years is None:
+        return obj
+    rows = obj[years == year]
+    return rows.droplevel("year") if "year" in rows.index.names else rows
+
+
+def split_years(obj):
+    years = index_years(obj)
+    if years is None:
+        return None
+    return {int(year): year_rows(obj, year) for year in years.unique()}
+
+
+def key_dtypes(data):
+    """Categorical dtypes shared by the key levels of all datasets in ``data``."""
+    values = {key: set() for key in KEYS.values()}
+    if "nuts" in data:
+        values["nuts"].update(data["nuts"].index)
+    for name in PARTITIONED:
+        index = data[name].index
+        for level, key in KEYS.items():
+            if level in index.names:
+                values[key].update(index.levels[index.names.index(level)])
+    return {key: pd.CategoricalDtype(sorted(keys)) for key, keys in values.items()}
+
+
+def categorize(obj, dtypes):
+    """Turn the key levels of ``obj`` into categoricals, touching only the levels."""
+    index = obj.index
+    if not isinstance(index, pd.MultiIndex):
+        return obj
+    for i, level in enumerate(index.names):
+        if level in KEYS:
+            categories = pd.CategoricalIndex(index.levels[i], dtype=dtypes[KEYS[level]])
+            index = index.set_levels(categories, level=i)
+    return obj.set_axis(index)
+
+
+def categorize_data(data):
+    dtypes = key_dtypes(data)
+    for name in PARTITIONED:
+        data[name] = categorize(data[name], dtypes)
+    return data
+
+
+def to_table(obj):
+    meta = {}
+    if isinstance(obj, pd.Series):
+        meta["series"] = obj.name
+        obj = obj.to_frame(name="values" if obj.name is None else obj.name)
+    if isinstance(obj, gpd.GeoDataFrame):
+        geometry = obj.geometry.name
+        meta["geometry"] = geometry
+        meta["crs"] = obj.crs.to_wkt() if obj.crs else None
+        obj = pd.DataFrame(obj).assign(**{geometry: obj.geometry.to_wkb()})
+
+    table = pa.Table.from_pandas(obj)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"agro"] = json.dumps(meta).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def from_table(table, columns=None):
+    meta = json.loads(table.schema.metadata.get(b"agro", b"{}"))
+    if columns is not None:
+        pandas_meta = json.loads(table.schema.metadata[b"pandas"])
+        index = [c for c in pandas_meta["index_columns"] if isinstance(c, str)]
+        table = table.select(list(columns) + index)
+
+    # split_blocks keeps numeric columns as zero-copy views of the mapped file
+    df = table.to_pandas(split_blocks=True)
+    geometry = meta.get("geometry")
+    if geometry in df:
+        df = gpd.GeoDataFrame(
+            df,
+            geometry=gpd.GeoSeries.from_wkb(df[geometry], index=df.index),
+            crs=meta["crs"],
+        )
+    if "series" in meta:
+        df = df.iloc[:, 0].rename(meta["series"])
+    return df
+
+
+def write_dataset(obj, directory, name):
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        try:
+            table = to_table(obj)
+        except (pa.ArrowException, TypeError, ValueError):
+            logger.warning("%s is not tabular, falling back to pickle", name)
+        else:
+            filename = f"{name}.arrow"
+            # Uncompressed IPC files, so that they can be memory-mapped
+            with pa.OSFile(os.path.join(directory, filename), "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            return filename
+
+    filename = f"{name}.pkl"
+    with open(os.path.join(directory, filename), "wb") as handle:
+        pickle.dump(obj, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    return filename
+
+
+def read_dataset(path, columns=None):
+    if path.endswith(".pkl"):
+        with open(path, "rb") as handle:
+            return pickle.load(handle)
+
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return from_table(table, columns)
+
+
+def write_data(data, directory):
+    os.makedirs(directory, exist_ok=True)
+    # Arrow keeps the categories, so every year is read with the same ones
+    data = categorize_data(dict(data))
+    manifest = {}
+    for name, obj in data.items():
+        years = split_years(obj) if name in PARTITIONED else None
+        if years is None:
+            manifest[name] = write_dataset(obj, directory, name)
+        else:
+            manifest[name] = {
+                str(year): write_dataset(part, directory, f"{name}-{year}")
+                for year, part in sorted(years.items())
+            }
+    with open(os.path.join(directory, MANIFEST), "w") as handle:
+        json.dump(manifest, handle, indent=2)
+    return manifest
+
+
+def convert(path=DATA_PATH, directory=DATA_DIR):
+    return write_data(fetch_data(path), directory)
+
+
+def nbytes(obj):
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep=True))
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    return sys.getsizeof(obj)
+
+
+def freeze(obj, depth=2):
+    """Make the arrays held by ``obj`` read-only; returns ``obj``.
+
+    Datasets are shared by the threads serving requests: a callback writing
+    into one raises instead of changing what the others see. Arrays mapped
+    from Arrow files already are read-only. Frames with writable columns are
+    replaced by a frozen copy, in ``obj`` and in the containers holding it.
+    """
+    if isinstance(obj, np.ndarray):
+        obj.flags.writeable = False
+    elif sparse.issparse(obj):
+        for array in (
+            obj.data,
+            getattr(obj, "indices", None),
+            getattr(obj, "indptr", None),
+        ):
+            if array is not None:
+                freeze(array)
+    elif isinstance(obj, pd.Index):
+        # Pandas builds the hash table of an index on its first lookup, which
+        # threads racing on it can see half built
+        if obj.is_unique:
+            obj.get_indexer(obj[:1])
+    elif isinstance(obj, pd.Series):
+        freeze(obj.index)
+        # Object arrays are left writable, like the Arrow mapped ones: pandas
+        # does not take them read-only
+        if isinstance(obj.dtype, np.dtype) and obj.dtype != object:
+            # A view of a block of a frame: freeze the arrays it views as well
+            array = obj.to_numpy()
+            while isinstance(array, np.ndarray):
+                freeze(array)
+                array = array.base
+    elif isinstance(obj, pd.DataFrame):
+        columns = [column for _, column in obj.items()]
+        if any(writable(column) for column in columns):
+            # The blocks may be views the columns do not see through, e.g.
+            # of the transposed array of the frame: a copy owns its blocks
+            obj = obj.copy()
+            columns = [column for _, column in obj.items()]
+        for column in columns:
+            freeze(column)
+        freeze(obj.index)
+    elif isinstance(obj, dict) and depth:
+        for key, value in obj.items():
+            obj[key] = freeze(value, depth - 1)
+    elif hasattr(obj, "__dict__") and depth:
+        # Containers of arrays, e.g. src.network.Incidence
+        attributes = vars(obj)
+        for key, value in attributes.items():
+            attributes[key] = freeze(value, depth - 1)
+    return obj
+
+
+def writable(series):
+    return (
+        isinstance(series.dtype, np.dtype)
+        and series.dtype != object
+        and series.to_numpy().flags.writeable
+    )
+
+
+def shallow(obj):
+    """A frame or series of its own, sharing the arrays of ``obj``."""
+    if isinstance(obj, (pd.Series, pd.DataFrame)):
+        return obj.copy(deep=False)
+    return obj
+
+
+class DataStore:
+    """Lazily loaded datasets, shared read-only by all pages of the process.
+
+    Raw and derived (see ``derive``) datasets are loaded once, on first access.
+    The datasets in ``PARTITIONED`` are also available per year, as
+    ``store["prods:2018"]``, and so are derived datasets whose function takes
+    a ``year`` argument.
+
+    Datasets are loaded under a lock and their arrays frozen (see ``freeze``),
+    so that concurrent requests can read them. Frames and series are handed
+    out as shallow copies: adding or replacing a column changes the copy of
+    the caller only, writing into one raises.
+    """
+
+    def __init__(self, path=None):
+        self._derived = {}
+        self._lock = threading.RLock()
+        self._loading = threading.local()
+        self.open(path)
+
+    def open(self, path=None):
+        """Serve the datasets at ``path``, dropping those already loaded."""
+        self.path = path or default_path()
+        self.stats = {}
+        # The datasets every load read directly, see src.precompute
+        self.inputs = {}
+        self._data = {}
+        self._source = None
+        self._manifest = None
+
+    def derive(self, name):
+        def decorator(func):
+            self._derived[name] = func
+            return func
+
+        return decorator
+
+    @property
+    def version(self):
+        path = self.path
+        if os.path.isdir(path):
+            path = os.path.join(path, MANIFEST)
+        return f"{os.path.abspath(path)}:{os.stat(path).st_mtime_ns}"
+
+    def __contains__(self, name):
+        """Whether ``name`` is derived, or raw and present in the data."""
+        base, _, year = name.rpartition(":")
+        if not year.isdigit():
+            base = name
+        if base in self._derived:
+            return True
+        if base not in DATASETS:
+            return False
+        manifest = self._read_manifest()
+        if manifest is not None:
+            return base in manifest
+        return base in self._data or base in self._read_source()
+
+    def years(self, name="prods"):
+        """The years ``name`` has data for, ascending."""
+        self._record(YEARS + name)
+        entry = self._manifest_entry(name)
+        if isinstance(entry, dict):
+            return sorted(int(year) for year in entry)
+        years = index_years(self[name])
+        return [] if years is None else sorted(int(year) for year in years.unique())
+
+    def _record(self, name):
+        # An input of the datasets being loaded by this thread
+        stack = getattr(self._loading, "stack", None)
+        if stack:
+            stack[-1].add(name)
+
+    def __getitem__(self, name):
+        self._record(name)
+        try:
+            return shallow(self._data[name])
+        except KeyError:
+            pass
+
+        with self._lock:
+            if name not in self._data:
+                start = time.perf_counter()
+                stack = getattr(self._loading, "stack", None) or []
+                self._loading.stack = stack
+                stack.append(set())
+                try:
+                    value = freeze(self._load(name))
+                finally:
+                    self.inputs[name] = stack.pop()
+                seconds = time.perf_counter() - start
+                self.stats[name] = {"seconds": seconds, "bytes": nbytes(value)}
+                logger.info(
+                    "loaded %s in %.2fs (%.1f MB)",
+                    name,
+                    seconds,
+                    self.stats[name]["bytes"] / 2**20,
+                )
+                self._data[name] = value
+        return shallow(self._data[name])
+
+    def _read_manifest(self):
+        if not os.path.isdir(self.path):
+            return None
+        if self._manifest is None:
+            with open(os.path.join(self.path, MANIFEST)) as handle:
+                self._manifest = json.load(handle)
+        return self._manifest
+
+    def _manifest_entry(self, name):
+        manifest = self._read_manifest()
+        return None if manifest is None else manifest[name]
+
+    def _persisted(self, name):
+        manifest = self._read_manifest()
+        return None if manifest is None else manifest.get(DERIVED, {}).get(name)
+
+    def _file(self, name):
+        """Arrow file of ``name`` in the data directory, None if it has none."""
+        entry = self._persisted(name)
+        base, _, year = name.rpartition(":")
+        if entry is None and year.isdigit() and base in PARTITIONED:
+            entry = (self._read_manifest() or {}).get(base)
+            entry = entry.get(year) if isinstance(entry, dict) else None
+        elif entry is None and name in DATASETS:
+            entry = (self._read_manifest() or {}).get(name)
+        if isinstance(entry, str) and entry.endswith(".arrow"):
+            return os.path.join(self.path, entry)
+        return None
+
+    def _load(self, name):
+        base, _, selection = name.partition("[")
+        if selection:
+            columns = selection.rstrip("]").split(",")
+            if base not in self._data and self._file(base):
+                return read_dataset(self._file(base), columns)
+            return self[base][columns]
+
+        entry = self._persisted(name)
+        if entry is not None:
+            return read_dataset(os.path.join(self.path, entry))
+        if name in self._derived:
+            return self._derived[name](self)
+        base, _, year = name.rpartition(":")
+        if year.isdigit() and base in self._derived:
+            return self._derived[base](self, year=int(year))
+        if year.isdigit() and base in PARTITIONED:
+            entry = self._manifest_entry(base)
+            if isinstance(entry, dict):
+                return read_dataset(os.path.join(self.path, entry[year]))
+            return year_rows(self[base], int(year))
+        if name not in DATASETS:
+            raise KeyError(name)
+
+        entry = self._manifest_entry(name)
+        if isinstance(entry, dict):
+            return pd.concat([self[partition(name, year)] for year in self.years(name)])
+        if entry is not None:
+            return read_dataset(os.path.join(self.path, entry))
+
+        return self._read_source().pop(name)
+
+    def _read_source(self):
+        # The pickle holds every dataset, so it is read once and its entries
+        # are handed out as they are requested.
+        if self._source is None:
+            self._source = categorize_data(fetch_data(self.path))
+        return self._source
+
+    def report(self):
+        return pd.DataFrame.from_dict(self.stats, orient="index")
+
+
+store = DataStore()
+
+
+@store.derive("nuts3")
+def greek_nuts3(store):
+    nuts = store["nuts"]
+    return nuts[(nuts["LEVL_CODE"] == 3) & (nuts["CNTR_CODE"] == "EL")]
+
+
+@store.derive("products")
+def product_index(store):
+    """(product_group, product_name) pairs of the latest year."""
+    prods = store[partition("prods", store.years()[-1])]
+    return prods.index.droplevel(["date", "nuts"]).unique()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert the pickled datasets to memory-mappable Arrow files"
+    )
+    parser.add_argument("source", nargs="?", default=DATA_PATH)
+    parser.add_argument("target", nargs="?", default=DATA_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for name, filename in convert(args.source, args.target).items():
+        logger.info("%s -> %s", name, filename)
@@ -0,0 +1,104 @@
+import os
+import time
+from contextlib import contextmanager
+
+import diskcache
+import psutil
+from dash.long_callback import DiskcacheLongCallbackManager
+from prometheus_client import multiprocess
+
+from src.io import store
+from src.metrics import JOB_SECONDS
+
+JOBS_DIR = os.environ.get("AGRO_JOBS_DIR", "./cache-directory")
+MAX_JOBS = int(os.environ.get("AGRO_MAX_JOBS", 2))
+SLOTS_KEY = "job-slots"
+
+_long_callbacks = []
+
+
+class JobManager(DiskcacheLongCallbackManager):
+    """Long callback manager that loads the datasets a job needs up front.
+
+    Jobs run in forked processes: datasets already loaded in the server
+    process are inherited by the job instead of being loaded again by each
+    of them. Year partitions (``"ods:{year}"``) are loaded for the latest year.
+
+    The metrics a job records stay in its process, unless they are collected
+    across processes (see src.metrics). Its duration is recorded by the
+    server process that gets its result.
+    """
+
+    def __init__(self, cache, prefetch=(), **kwargs):
+        super().__init__(cache, **kwargs)
+        self.prefetch = set(prefetch)
+
+    def call_job_fn(self, key, job_fn, args):
+        latest = store.years()[-1]
+        for name in self.prefetch:
+            store[name.format(year=latest)]
+        # In the cache, the result may be fetched by another worker
+        self.handle.set(f"{key}-start", time.time(), expire=24 * 3600)
+        return super().call_job_fn(key, job_fn, args)
+
+    def get_result(self, key, job):
+        result = super().get_result(key, job)
+        if result is not None:
+            start = self.handle.pop(f"{key}-start", None)
+            if start is not None:
+                JOB_SECONDS.observe(time.time() - start)
+        return result
+
+    def terminate_job(self, job):
+        super().terminate_job(job)
+        if job and "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            multiprocess.mark_process_dead(job)
+
+
+cache = diskcache.Cache(JOBS_DIR)
+manager = JobManager(cache)
+
+
+def long_callback(*args, prefetch=(), **kwargs):
+    """Declare a long callback from a page module.
+
+    Pages are imported while the app is constructed, so the callbacks are
+    collected here and attached to the app by ``register``.
+    """
+
+    def decorator(func):
+        _long_callbacks.append((func, args, kwargs))
+        manager.prefetch.update(prefetch)
+        return func
+
+    return decorator
+
+
+def register(app):
+    for func, args, kwargs in _long_callbacks:
+        app.long_callback(*args, **kwargs)(func)
+
+
+@contextmanager
+def job_slot(waiting=None, poll=0.5):
+    """Wait for one of the ``MAX_JOBS`` job slots shared by all processes.
+
+    Slots are held by process id, so that the slot of a job that got
+    terminated (e.g. superseded by a newer click) is reclaimed.
+    """
+    pid = os.getpid()
+    while True:
+        with cache.transact():
+            running = [p for p in cache.get(SLOTS_KEY, []) if psutil.pid_exists(p)]
+            if len(running) < MAX_JOBS:
+                cache.set(SLOTS_KEY, running + [pid])
+                break
+        if waiting:
+            waiting()
+        time.sleep(poll)
+
+    try:
+        yield
+    finally:
+        with cache.transact():
+            cache.set(SLOTS_KEY, [p for p in cache.get(SLOTS_KEY, []) if p != pid])
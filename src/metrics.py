@@ -0,0 +1,145 @@
+import contextvars
+import functools
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import flask
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+SLOW_SECONDS = float(os.environ.get("AGRO_SLOW_MS", 2000)) / 1000
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_SECONDS = Histogram(
+    "agro_callback_seconds", "Duration of a page callback", ["callback"]
+)
+STAGE_SECONDS = Histogram(
+    "agro_stage_seconds",
+    "Duration of a stage of a page callback",
+    ["callback", "stage"],
+)
+STAGE_ROWS = Histogram(
+    "agro_stage_rows",
+    "Rows produced by a stage of a page callback",
+    ["callback", "stage"],
+    buckets=(10, 100, 1e3, 1e4, 1e5, 1e6, 1e7, float("inf")),
+)
+RESPONSE_SECONDS = Histogram(
+    "agro_response_seconds",
+    "Duration of a callback request, including serialization",
+    ["output"],
+)
+RESPONSE_BYTES = Histogram(
+    "agro_response_bytes",
+    "Size of a callback response",
+    ["output"],
+    buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8, float("inf")),
+)
+JOB_SECONDS = Histogram(
+    "agro_job_seconds",
+    "Duration of a long callback job, from its start to its result",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf")),
+)
+CACHE_REQUESTS = Counter(
+    "agro_cache_requests",
+    "Memoized callback lookups (see src.cache)",
+    ["callback", "result"],
+)
+
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.seconds = None
+
+
+def instrument(func):
+    """Time a callback and the stages (see ``stage``) it runs."""
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stages = []
+        token = _trace.set((name, stages))
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            _trace.reset(token)
+            CALLBACK_SECONDS.labels(name).observe(seconds)
+            if seconds > SLOW_SECONDS:
+                logger.warning(
+                    "slow callback %s: %.0f ms [%s]",
+                    name,
+                    seconds * 1000,
+                    ", ".join(
+                        f"{s.name} {s.seconds * 1000:.0f} ms"
+                        + (f" ({s.rows} rows)" if s.rows is not None else "")
+                        for s in stages
+                    ),
+                )
+
+    return wrapper
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the current callback, ``rows`` can be set on the result."""
+    current = Stage(name)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - start
+        trace = _trace.get()
+        if trace is not None:
+            callback, stages = trace
+            stages.append(current)
+            STAGE_SECONDS.labels(callback, name).observe(current.seconds)
+            if current.rows is not None:
+                STAGE_ROWS.labels(callback, name).observe(current.rows)
+
+
+def before_request():
+    flask.g.metrics_start = time.perf_counter()
+
+
+def after_request(response):
+    if flask.request.path.endswith("/_dash-update-component"):
+        output = (flask.request.get_json(silent=True) or {}).get("output", "")
+        RESPONSE_SECONDS.labels(output).observe(
+            time.perf_counter() - flask.g.metrics_start
+        )
+        RESPONSE_BYTES.labels(output).observe(len(response.get_data()))
+    return response
+
+
+def metrics():
+    # Set PROMETHEUS_MULTIPROC_DIR to collect the metrics of every worker and
+    # long callback job, rather than those of this process
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return flask.Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(server):
+    server.before_request(before_request)
+    server.after_request(after_request)
+    server.add_url_rule("/metrics", "metrics", metrics)
@@ -0,0 +1,279 @@
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src import paths  # noqa: F401, registers the path engine
+from src.io import partition, store
+
+# Deltas applied to a session's volumes before they are recomputed in full,
+# which bounds the accumulated rounding
+MAX_DELTAS = 20
+# Volumes (tn) below this are rounding left by removed selections
+ZERO = 1e-6
+
+
+def path_table(spaths):
+    """Flatten ``spaths`` to one (source, target) key and link osmid per step."""
+    if spaths.index.nlevels > 2:
+        keys = spaths.index.droplevel(list(range(2, spaths.index.nlevels)))
+        return keys, spaths.to_numpy()
+
+    # One sequence of link osmids per (source, target)
+    paths = [np.asarray(path).ravel() for path in spaths]
+    keys = spaths.index.repeat([len(path) for path in paths])
+    values = np.concatenate(paths) if paths else np.array([], dtype="int64")
+    return keys, values
+
+
+def lookup(series, labels):
+    """Values of ``series`` at ``labels``, NaN where missing.
+
+    Categorical labels are looked up once per category, not once per row.
+    """
+    if isinstance(labels, pd.CategoricalIndex):
+        values = series.reindex(labels.categories).to_numpy(dtype="float64")
+        return np.where(labels.codes >= 0, values[labels.codes], np.nan)
+    return series.reindex(labels).to_numpy()
+
+
+class Incidence:
+    """Sparse links x OD-pairs incidence matrix of the shortest paths."""
+
+    def __init__(self, matrix, links, pairs):
+        self.matrix = matrix
+        self.links = links
+        self.pairs = pairs
+
+    @classmethod
+    def from_paths(cls, keys, values):
+        pair_codes, pairs = pd.factorize(keys)
+        link_codes, links = pd.factorize(values)
+        # Duplicate (link, pair) entries are summed, like the per-path concat
+        matrix = sparse.csr_matrix(
+            (np.ones(len(values)), (link_codes, pair_codes)),
+            shape=(len(links), len(pairs)),
+        )
+        return cls(
+            matrix, pd.Index(links, name="osmid"), pd.MultiIndex.from_tuples(pairs)
+        )
+
+    def pair_columns(self, origins, destinations, osmids):
+        """Path column of every (origin, destination) NUTS pair, -1 if none."""
+        src = lookup(osmids, origins)
+        tgt = lookup(osmids, destinations)
+        cols = self.pairs.get_indexer(pd.MultiIndex.from_arrays([src, tgt]))
+        cols[src == tgt] = -1
+        return cols
+
+    def column_vector(self, cols, weights):
+        valid = cols >= 0
+        return np.bincount(
+            cols[valid], weights=weights[valid], minlength=len(self.pairs)
+        )
+
+
+def missing_pairs(keys, osmids):
+    """(source, target) pairs of distinct NUTS nodes without a path in ``keys``."""
+    osmids = pd.unique(osmids.dropna())
+    pairs = pd.MultiIndex.from_product([osmids, osmids])
+    pairs = pairs[pairs.get_level_values(0) != pairs.get_level_values(1)]
+    return pairs.difference(keys.unique())
+
+
+@store.derive("incidence")
+def build_incidence(store):
+    keys, values = path_table(store["spaths"])
+    # Pairs the precomputed paths do not cover are routed on the network
+    missing = missing_pairs(keys, store["nuts3"]["osmid"])
+    if len(missing) and "net" in store:
+        extra_keys, extra_values = store["path_engine"].path_table(missing)
+        keys = keys.append(extra_keys)
+        values = np.concatenate([values, extra_values])
+    return Incidence.from_paths(keys, values)
+
+
+@store.derive("od_columns")
+def build_od_columns(store, year=None):
+    """Path column of every row of ``ods``, see ``Incidence.pair_columns``."""
+    index = store[partition("ods", year)].index
+    return store["incidence"].pair_columns(
+        index.get_level_values("origin_nuts"),
+        index.get_level_values("destination_nuts"),
+        store["nuts3"]["osmid"],
+    )
+
+
+@store.derive("pair_rows")
+def build_pair_rows(store, year=None):
+    """Sparse OD-pairs x ods rows matrix, the rows assigned to every path column."""
+    cols = store[partition("od_columns", year)]
+    rows = np.flatnonzero(cols >= 0)
+    return sparse.csr_matrix(
+        (np.ones(len(rows)), (cols[rows], rows)),
+        shape=(len(store["incidence"].pairs), len(cols)),
+    )
+
+
+def selection_mask(index, products=None, origins=None):
+    """Rows of ``ods`` in the (product, origin) cells of a selection."""
+    mask = np.ones(len(index), dtype=bool)
+    for level, values in (("product_name", products), ("origin_nuts", origins)):
+        if values:
+            level = index.names.index(level)
+            mask &= index.levels[level].isin(values)[index.codes[level]]
+    return mask
+
+
+class LinkCells:
+    """Sparse links x (product, origin) matrix of the assigned OD volumes.
+
+    Every selection of the assignment page is a set of (product_name,
+    origin_nuts) cells, so its link volumes are a sum of columns.
+    """
+
+    def __init__(self, matrix, links, cells):
+        self.matrix = matrix
+        self.links = links
+        self.cells = cells
+
+    @classmethod
+    def from_ods(cls, incidence, ods, cols):
+        valid = cols >= 0
+        index = ods.index[valid]
+        cell_codes, cells = pd.MultiIndex.from_arrays(
+            [
+                index.get_level_values("product_name"),
+                index.get_level_values("origin_nuts"),
+            ]
+        ).factorize(sort=True)
+        # OD volumes summed by (path column, cell)
+        volumes = sparse.csr_matrix(
+            (ods.to_numpy()[valid], (cols[valid], cell_codes)),
+            shape=(len(incidence.pairs), len(cells)),
+        )
+        cells = cells.set_names(["product_name", "origin_nuts"])
+        return cls((incidence.matrix @ volumes).tocsc(), incidence.links, cells)
+
+    def mask(self, products=None, origins=None):
+        return selection_mask(self.cells, products, origins)
+
+    def volumes(self, weights):
+        """Link volumes of the cells, weighted (e.g. a selection mask)."""
+        return self.matrix @ np.asarray(weights, dtype="float64")
+
+    def breakdown(self, products=None, origins=None):
+        """Links x products volumes of a selection."""
+        codes = np.flatnonzero(self.mask(products, origins))
+        product_codes, products = pd.factorize(
+            self.cells.get_level_values("product_name")[codes]
+        )
+        grouping = sparse.csr_matrix(
+            (np.ones(len(codes)), (codes, product_codes)),
+            shape=(len(self.cells), len(products)),
+        )
+        return pd.DataFrame(
+            (self.matrix @ grouping).toarray(),
+            index=self.links,
+            columns=pd.Index(products, name="product_name"),
+        )
+
+
+@store.derive("link_cells")
+def build_link_cells(store, year=None):
+    return LinkCells.from_ods(
+        store["incidence"],
+        store[partition("ods", year)],
+        store[partition("od_columns", year)],
+    )
+
+
+def select_link(osmid, products=None, origins=None, year=None):
+    """Rows of ``ods`` in the selection whose paths use link ``osmid``.
+
+    The row of the link in the incidence matrix is its list of OD pairs, and
+    ``pair_rows`` maps those to the rows of ``ods``, so no path is scanned.
+    Volumes are multiplied by the number of times the path uses the link.
+    """
+    incidence = store["incidence"]
+    ods = store[partition("ods", year)]
+    position = incidence.links.get_indexer([osmid])[0]
+    if position < 0:
+        return ods.iloc[:0]
+
+    uses = incidence.matrix[position] @ store[partition("pair_rows", year)]
+    rows, counts = uses.indices, uses.data
+    mask = selection_mask(ods.index[rows], products, origins)
+    return ods.iloc[rows[mask]] * counts[mask]
+
+
+@lru_cache(maxsize=8)
+def closed_engine(osmids):
+    return store["path_engine"].closed(list(osmids))
+
+
+def close_links(osmids, products=None, origins=None, year=None):
+    """Link volumes of the selection with the links ``osmids`` closed.
+
+    Only the OD pairs whose paths use a closed link are rerouted, on the
+    road network. Returns the base and scenario volumes by link osmid, and
+    the volume of the pairs left without a path.
+    """
+    incidence = store["incidence"]
+    base, _ = assign_selection(products, origins, year=year)
+
+    rows = incidence.links.get_indexer(pd.Index(osmids))
+    affected = np.unique(incidence.matrix[rows[rows >= 0]].indices)
+    ods = store[partition("ods", year)]
+    cols = store[partition("od_columns", year)]
+    mask = selection_mask(ods.index, products, origins)
+    mask &= np.isin(cols, affected)
+    weights = incidence.column_vector(cols[mask], ods.to_numpy()[mask])
+    affected = affected[weights[affected] > 0]
+
+    # The affected volumes come off their paths and go onto the new ones
+    pairs = incidence.pairs[affected]
+    keys, links = closed_engine(tuple(sorted(osmids))).path_table(pairs)
+    rerouted = pd.Series(weights[affected], index=pairs)
+    scenario = pd.Series(base - incidence.matrix @ weights, index=incidence.links)
+    scenario = scenario.add(rerouted.reindex(keys).groupby(links).sum(), fill_value=0)
+    scenario[np.abs(scenario) < ZERO] = 0
+
+    volumes = pd.DataFrame(
+        {"base": pd.Series(base, index=incidence.links), "scenario": scenario}
+    ).fillna(0)
+    stranded = rerouted[~pairs.isin(keys)].sum()
+    return volumes.rename_axis("osmid"), stranded
+
+
+def assign_selection(products=None, origins=None, previous=None, year=None):
+    """Link volumes (aligned to the incidence links) of the selected ODs.
+
+    The volumes are a sum of columns of ``link_cells``. ``previous`` is the
+    state returned by an earlier call. When given, only the cells added to
+    or removed from its selection are summed, unless they outnumber the
+    cells of the new selection. Returns the volumes and the state to pass
+    to the next call.
+    """
+    cells = store[partition("link_cells", year)]
+    mask = cells.mask(products, origins)
+    state = dict(version=(store.version, year), products=products, origins=origins)
+
+    if (
+        previous is not None
+        and previous["version"] == state["version"]
+        and previous["deltas"] < MAX_DELTAS
+    ):
+        old = cells.mask(previous["products"], previous["origins"])
+        added, removed = mask & ~old, old & ~mask
+        if (added | removed).sum() < mask.sum():
+            volumes = previous["volumes"] + cells.volumes(
+                added.astype("int8") - removed.astype("int8")
+            )
+            # Cancel the rounding left over by removed cells
+            volumes[np.abs(volumes) < ZERO] = 0
+            return volumes, dict(state, volumes=volumes, deltas=previous["deltas"] + 1)
+
+    volumes = cells.volumes(mask)
+    return volumes, dict(state, volumes=volumes, deltas=0)
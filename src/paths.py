@@ -0,0 +1,177 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from src.io import store
+
+# Shortest-path trees (one predecessor array per source node) kept in memory
+TREE_CACHE = int(os.environ.get("AGRO_TREE_CACHE", 64))
+# Sources per Dijkstra call
+BATCH = 16
+# Link attributes kept besides the length, see src.equilibrium
+ATTRIBUTES = ("highway", "lanes", "maxspeed")
+
+logger = logging.getLogger(__name__)
+
+
+def scalar(osmid):
+    # Simplified osmnx edges carry the list of the ways they merge
+    return osmid[0] if isinstance(osmid, (list, tuple)) else osmid
+
+
+class PathEngine:
+    """Shortest paths on the road network, as sequences of link osmids.
+
+    The network is held as a CSR matrix of link lengths, its links (node
+    positions and attributes) as a frame in the order of the CSR entries. Dijkstra runs for
+    batches of sources at once, and the resulting trees are kept in a
+    bounded LRU cache, so paths from recent sources are only walked.
+    """
+
+    def __init__(self, graph, nodes, links, cache_size=TREE_CACHE):
+        self.graph = graph
+        self.nodes = nodes
+        self.links = links
+        self.cache_size = cache_size
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+        # Links are sorted by (row, col) node position, like the CSR entries
+        self._keys = links["u"].to_numpy() * len(nodes) + links["v"].to_numpy()
+
+    @classmethod
+    def from_net(cls, net):
+        links = pd.DataFrame(
+            [
+                dict(
+                    {key: data.get(key) for key in ATTRIBUTES},
+                    u=u,
+                    v=v,
+                    length=data.get("length", 1.0),
+                    osmid=scalar(data.get("osmid")),
+                )
+                for u, v, data in net.edges(data=True)
+            ]
+        )
+        nodes = pd.Index(list(net.nodes))
+        links["u"] = nodes.get_indexer(links["u"])
+        links["v"] = nodes.get_indexer(links["v"])
+        # Of parallel links keep the shortest
+        links = links.sort_values("length").drop_duplicates(["u", "v"])
+        links = links.sort_values(["u", "v"], ignore_index=True)
+
+        # Explicit zeros are edges for csgraph, but keep them positive anyway
+        lengths = np.maximum(links["length"].to_numpy(dtype="float64"), 1e-9)
+        indptr = np.searchsorted(links["u"], np.arange(len(nodes) + 1))
+        graph = sparse.csr_matrix(
+            (lengths, links["v"].to_numpy(), indptr), shape=(len(nodes), len(nodes))
+        )
+        return cls(graph, nodes, links)
+
+    def link_positions(self, rows, cols):
+        """Positions in ``links`` of the links between node positions."""
+        return np.searchsorted(self._keys, rows * len(self.nodes) + cols)
+
+    def weighted(self, costs):
+        """The network graph with ``costs`` (aligned to ``links``) as lengths."""
+        graph = self.graph.copy()
+        graph.data = np.maximum(costs, 1e-9)
+        return graph
+
+    def closed(self, osmids):
+        """An engine without the links ``osmids``, with a cache of its own."""
+        costs = self.graph.data.copy()
+        costs[self.links["osmid"].isin(osmids).to_numpy()] = np.inf
+        graph = self.graph.copy()
+        graph.data = costs
+        return PathEngine(graph, self.nodes, self.links, self.cache_size)
+
+    def __getstate__(self):
+        # The trees and the lock are per process
+        state = dict(vars(self), _trees=OrderedDict())
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        vars(self).update(state, _lock=threading.Lock())
+
+    def trees(self, sources):
+        """Predecessor arrays of the ``sources`` (node positions)."""
+        with self._lock:
+            trees = {s: self._trees[s] for s in sources if s in self._trees}
+        # Dijkstra runs outside the lock, the cache is only updated under it
+        missing = [s for s in dict.fromkeys(sources) if s not in trees]
+        for start in range(0, len(missing), BATCH):
+            batch = missing[start : start + BATCH]
+            _, predecessors = csgraph.dijkstra(
+                self.graph, indices=batch, return_predecessors=True
+            )
+            for source, tree in zip(batch, predecessors):
+                trees[source] = tree.astype("int32")
+                trees[source].flags.writeable = False
+
+        with self._lock:
+            for source in trees:
+                self._trees[source] = trees[source]
+                self._trees.move_to_end(source)
+            while len(self._trees) > self.cache_size:
+                self._trees.popitem(last=False)
+        return {source: trees[source] for source in sources}
+
+    def path_table(self, pairs):
+        """Keys and link osmids of the paths of (source, target) node osmid pairs.
+
+        Same layout as ``src.network.path_table``; unreachable pairs and nodes
+        missing from the network are left out.
+        """
+        if not len(pairs):
+            return (
+                pd.MultiIndex.from_arrays([[], []]),
+                self.links["osmid"].to_numpy()[:0],
+            )
+        pairs = pd.MultiIndex.from_tuples(pairs)
+        src = self.nodes.get_indexer(pairs.get_level_values(0))
+        tgt = self.nodes.get_indexer(pairs.get_level_values(1))
+        known = (src >= 0) & (tgt >= 0)
+
+        keys, steps, found = [], [], 0
+        by_source = pd.Series(np.flatnonzero(known)).groupby(src[known])
+        sources = list(by_source.groups)
+        # Batches of at most cache_size sources, so that no tree is evicted
+        # before its paths are walked
+        for start in range(0, len(sources), self.cache_size):
+            batch = sources[start : start + self.cache_size]
+            for source, tree in self.trees(batch).items():
+                for i in by_source.get_group(source):
+                    path = [tgt[i]]
+                    while path[-1] != source and path[-1] >= 0:
+                        path.append(tree[path[-1]])
+                    if path[-1] < 0:
+                        continue
+                    path = path[::-1]
+                    found += 1
+                    keys.extend([pairs[i]] * (len(path) - 1))
+                    steps.extend(zip(path[:-1], path[1:]))
+
+        if found < len(pairs):
+            logger.warning(
+                "no path for %d of %d OD pairs", len(pairs) - found, len(pairs)
+            )
+        if not keys:
+            return (
+                pd.MultiIndex.from_arrays([[], []]),
+                self.links["osmid"].to_numpy()[:0],
+            )
+        rows, cols = np.array(steps).T
+        osmids = self.links["osmid"].to_numpy()
+        return pd.MultiIndex.from_tuples(keys), osmids[self.link_positions(rows, cols)]
+
+
+@store.derive("path_engine")
+def build_path_engine(store):
+    return PathEngine.from_net(store["net"])
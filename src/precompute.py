@@ -0,0 +1,299 @@
+import argparse
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import shutil
+
+# Registers the derived datasets
+from src import aggregates, equilibrium, geometry, gravity, network, tiles  # noqa: F401
+from src.aggregates import DIRECTIONS, PRODUCT_LEVELS, cube_name
+from src.io import (
+    DATA_DIR,
+    DATASETS,
+    DERIVED,
+    MANIFEST,
+    YEARS,
+    partition,
+    store,
+    fetch_data,
+    write_data,
+    write_dataset,
+)
+
+# Build records of the stages (their inputs and hash), under the data directory
+STAGES = os.path.join(DERIVED, "stages.json")
+# Hash of the pickle the data directory was converted from
+SOURCE = "__source__"
+
+logger = logging.getLogger(__name__)
+
+
+def default_stages(store):
+    """Every derived dataset the pages use, in dependency order."""
+    names = ["nuts3", "products", "nuts_geojson", "nuts_bounds"]
+    for year in store.years():
+        names += [
+            cube_name(direction, level, year)
+            for direction in DIRECTIONS
+            for level in PRODUCT_LEVELS
+        ]
+        names += [partition("od_tensor", year)]
+    names += ["path_engine", "incidence", "bpr_links", "nuts_costs"]
+    for year in store.years():
+        names += [
+            partition(name, year) for name in ("od_columns", "link_cells", "pair_rows")
+        ]
+    return names + ["link_lines", "link_polygons", "link_mercator"]
+
+
+def file_hash(path, files):
+    """sha256 of a file, reused from ``files`` while its size and mtime hold."""
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    cached = files.get(key)
+    if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(2**20), b""):
+            digest.update(chunk)
+    files[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def class_modules(obj, depth=2):
+    """Modules of this package defining the classes ``obj`` is made of."""
+    modules = set()
+    if type(obj).__module__.startswith("src."):
+        modules.add(type(obj).__module__)
+    if isinstance(obj, dict) and depth:
+        values = obj.values()
+    elif isinstance(obj, (list, tuple)) and depth:
+        values = obj
+    elif hasattr(obj, "__dict__") and depth:
+        values = vars(obj).values()
+    else:
+        values = ()
+    for value in values:
+        modules |= class_modules(value, depth - 1)
+    return modules
+
+
+class Pipeline:
+    """Derived datasets written under ``derived/<hash>/`` of a data directory.
+
+    The hash of a stage covers the source of the module that derives it and
+    of the modules defining the classes of its artifact (unpickling runs
+    their code), the years it listed and the hashes of the datasets it read,
+    down to the raw data files. A stage whose hash is unchanged is not built
+    again.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.path = store.path
+        self.records = {"stages": {}, "files": {}}
+        if os.path.exists(os.path.join(self.path, STAGES)):
+            with open(os.path.join(self.path, STAGES)) as handle:
+                self.records = json.load(handle)
+        self.hashes = {}
+        # Class modules of the stages built in this run
+        self.built = {}
+
+    def raw_hash(self, name):
+        base, _, year = name.rpartition(":")
+        if not year.isdigit():
+            base, year = name, None
+        entry = self.store._manifest_entry(base)
+        if isinstance(entry, dict):
+            files = [entry[year]] if year else [entry[k] for k in sorted(entry)]
+        else:
+            files = [entry]
+        digest = hashlib.sha256(name.encode())
+        for filename in files:
+            digest.update(
+                file_hash(
+                    os.path.join(self.path, filename), self.records["files"]
+                ).encode()
+            )
+        return digest.hexdigest()
+
+    def inputs(self, name):
+        """The inputs of ``name``: as loaded in this run, or as last recorded."""
+        if name in self.store.inputs and self.store._persisted(name) is None:
+            return sorted(self.store.inputs[name])
+        record = self.records["stages"].get(name)
+        return None if record is None else record["inputs"]
+
+    def modules(self, name):
+        """Class modules of ``name``: as built in this run, or as last recorded."""
+        if name in self.built:
+            return self.built[name]
+        record = self.records["stages"].get(name)
+        return None if record is None else record.get("modules")
+
+    def hash(self, name):
+        """Hash of ``name``, None if its inputs are not known yet."""
+        if name in self.hashes:
+            return self.hashes[name]
+        base = name.rpartition(":")[0] if name.rpartition(":")[2].isdigit() else name
+        if name.endswith("]"):
+            # A projection (see src.io.projection) hashes as its dataset
+            source = self.hash(name.partition("[")[0])
+            if source is None:
+                return None
+            value = hashlib.sha256(json.dumps([name, source]).encode()).hexdigest()
+        elif name.startswith(YEARS):
+            years = self.store.years(name[len(YEARS) :])
+            value = hashlib.sha256(json.dumps([name, years]).encode()).hexdigest()
+        elif base in DATASETS:
+            value = self.raw_hash(name)
+        else:
+            inputs = self.inputs(name)
+            hashes = None if inputs is None else [self.hash(i) for i in inputs]
+            modules = self.modules(name)
+            if hashes is None or None in hashes or modules is None:
+                return None
+            func = self.store._derived[base]
+            code = hashlib.sha256()
+            for module in sorted({getattr(func, "func", func).__module__, *modules}):
+                path = inspect.getsourcefile(importlib.import_module(module))
+                with open(path, "rb") as handle:
+                    code.update(handle.read())
+            value = hashlib.sha256(
+                json.dumps([name, code.hexdigest(), list(zip(inputs, hashes))]).encode()
+            ).hexdigest()
+        self.hashes[name] = value
+        return value
+
+    def artifact(self, name, value):
+        directory = os.path.join(DERIVED, value[:16])
+        if not os.path.isdir(os.path.join(self.path, directory)):
+            return None
+        for filename in os.listdir(os.path.join(self.path, directory)):
+            if os.path.splitext(filename)[0] == name.replace(":", "-"):
+                return os.path.join(directory, filename)
+        return None
+
+    def run(self, names):
+        """Build (or reuse) the stages ``names``, returns their artifacts."""
+        artifacts = {}
+        for name in names:
+            value = self.hash(name)
+            artifact = value and self.artifact(name, value)
+            if artifact:
+                artifacts[name] = artifact
+                logger.info("%s unchanged (%s)", name, value[:16])
+                # Later stages that read it load the artifact
+                self.store._read_manifest()[DERIVED][name] = artifact
+                continue
+
+            obj = self.store[name]
+            self.built[name] = sorted(class_modules(obj))
+            self.hashes.pop(name, None)
+            value = self.hash(name)
+            directory = os.path.join(self.path, DERIVED, value[:16])
+            os.makedirs(directory, exist_ok=True)
+            filename = write_dataset(obj, directory, name.replace(":", "-"))
+            artifacts[name] = os.path.join(DERIVED, value[:16], filename)
+            self.records["stages"][name] = {
+                "hash": value,
+                "inputs": self.inputs(name),
+                "modules": self.built[name],
+            }
+            logger.info("%s built (%s)", name, value[:16])
+        return artifacts
+
+    def save(self, artifacts, prune=False):
+        """Point the manifest at ``artifacts``.
+
+        The other stages of the manifest are kept, unless ``prune``: then
+        they are dropped, and so are their artifacts.
+        """
+        with open(os.path.join(self.path, MANIFEST)) as handle:
+            manifest = json.load(handle)
+        if not prune:
+            artifacts = dict(manifest.get(DERIVED, {}), **artifacts)
+        manifest[DERIVED] = artifacts
+        with open(os.path.join(self.path, MANIFEST), "w") as handle:
+            json.dump(manifest, handle, indent=2)
+        with open(os.path.join(self.path, STAGES), "w") as handle:
+            json.dump(self.records, handle, indent=2)
+        if not prune:
+            return
+
+        used = {os.path.dirname(path) for path in artifacts.values()}
+        for entry in os.listdir(os.path.join(self.path, DERIVED)):
+            directory = os.path.join(DERIVED, entry)
+            if (
+                os.path.isdir(os.path.join(self.path, directory))
+                and directory not in used
+            ):
+                shutil.rmtree(os.path.join(self.path, directory))
+
+
+def convert(source, directory):
+    """Convert the pickle at ``source`` into ``directory`` unless it already was."""
+    records_path = os.path.join(directory, STAGES)
+    records = {"stages": {}, "files": {}}
+    if os.path.exists(records_path):
+        with open(records_path) as handle:
+            records = json.load(handle)
+    value = file_hash(source, records["files"])
+    if records.get(SOURCE) == value and os.path.exists(
+        os.path.join(directory, MANIFEST)
+    ):
+        logger.info("%s unchanged", source)
+        return
+    write_data(fetch_data(source), directory)
+    records[SOURCE] = value
+    os.makedirs(os.path.join(directory, DERIVED), exist_ok=True)
+    with open(records_path, "w") as handle:
+        json.dump(records, handle, indent=2)
+    logger.info("%s converted to %s", source, directory)
+
+
+def precompute(path=None, names=None):
+    """Build the derived datasets of the data at ``path`` (pickle or directory).
+
+    A pickle is converted to ``DATA_DIR`` first, see ``src.io.write_data``.
+    The store is then served from the directory.
+
+    ``names`` restricts the run to those stages, the artifacts of the others
+    are kept. A run of every stage drops the artifacts no longer used.
+    """
+    path = path or store.path
+    if not os.path.isdir(path):
+        convert(path, DATA_DIR)
+        path = DATA_DIR
+    store.open(path)
+    os.makedirs(os.path.join(path, DERIVED), exist_ok=True)
+
+    # Stages are built here, not read from the previous artifacts
+    store._read_manifest()[DERIVED] = {}
+    pipeline = Pipeline(store)
+    artifacts = pipeline.run(names or default_stages(store))
+    # Only a run of every stage knows which artifacts are no longer used
+    pipeline.save(artifacts, prune=names is None)
+    store.open(path)
+    return artifacts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the derived datasets into the data directory, "
+        "skipping those whose inputs did not change"
+    )
+    parser.add_argument(
+        "path", nargs="?", help="data pickle or directory (default: AGRO_DATA)"
+    )
+    parser.add_argument("--stage", action="append", dest="names", help="default: all")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger("src.io").setLevel(logging.WARNING)
+    for name, artifact in precompute(args.path, args.names).items():
+        logger.info("%s -> %s", name, artifact)
@@ -0,0 +1,224 @@
+import argparse
+import logging
+import pickle
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import networkx as nx
+from scipy import sparse
+from scipy.sparse import csgraph
+from shapely.geometry import LineString, box
+
+from src.io import write_data
+
+logger = logging.getLogger(__name__)
+
+# Greece, in EPSG:4326
+BOUNDS = (20.0, 35.0, 28.0, 41.5)
+EPSGS = {"world": 4326, "proj": 2100}
+
+
+def make_nuts(n_nuts, grid, rng):
+    x0, y0, x1, y1 = BOUNDS
+    cols = int(np.ceil(np.sqrt(n_nuts)))
+    rows = int(np.ceil(n_nuts / cols))
+    dx, dy = (x1 - x0) / cols, (y1 - y0) / rows
+    gx, gy = (x1 - x0) / grid, (y1 - y0) / grid
+
+    records = []
+    for k in range(n_nuts):
+        i, j = divmod(k, rows)
+        geometry = box(x0 + i * dx, y0 + j * dy, x0 + (i + 1) * dx, y0 + (j + 1) * dy)
+        # The network node closest to the centre of the region
+        a = int(round((geometry.centroid.x - x0) / gx))
+        b = int(round((geometry.centroid.y - y0) / gy))
+        records.append(
+            {
+                "id": f"EL{k:03d}",
+                "LEVL_CODE": 3,
+                "CNTR_CODE": "EL",
+                "NUTS_NAME": f"Ενότητα {k:03d}",
+                "osmid": node_id(a, b, grid),
+                "geometry": geometry,
+            }
+        )
+    records.append(
+        {
+            "id": "EL",
+            "LEVL_CODE": 0,
+            "CNTR_CODE": "EL",
+            "NUTS_NAME": "Ελλάδα",
+            "osmid": records[0]["osmid"],
+            "geometry": box(*BOUNDS),
+        }
+    )
+    nuts = gpd.GeoDataFrame(records, crs=EPSGS["world"]).set_index("id")
+    return nuts
+
+
+def node_id(a, b, grid):
+    return 1_000_000 + a * (grid + 1) + b
+
+
+def make_network(grid, rng):
+    """Grid road network, with a motorway every fifth row and column."""
+    x0, y0, x1, y1 = BOUNDS
+    gx, gy = (x1 - x0) / grid, (y1 - y0) / grid
+    net = nx.MultiDiGraph(crs=f"epsg:{EPSGS['world']}")
+    for a in range(grid + 1):
+        for b in range(grid + 1):
+            net.add_node(node_id(a, b, grid), x=x0 + a * gx, y=y0 + b * gy)
+
+    records = []
+    osmid = 100_000_000
+    for a in range(grid + 1):
+        for b in range(grid + 1):
+            for da, db in ((1, 0), (0, 1)):
+                if a + da > grid or b + db > grid:
+                    continue
+                u, v = node_id(a, b, grid), node_id(a + da, b + db, grid)
+                geometry = LineString(
+                    [
+                        (x0 + a * gx, y0 + b * gy),
+                        (x0 + (a + da) * gx, y0 + (b + db) * gy),
+                    ]
+                )
+                major = (b if da else a) % 5 == 0
+                highway = "motorway" if major else "primary"
+                length = float(rng.uniform(0.9, 1.3) * 111_000 * max(gx, gy))
+                attrs = dict(osmid=osmid, length=length, highway=highway)
+                net.add_edge(u, v, geometry=geometry, **attrs)
+                net.add_edge(v, u, geometry=geometry, **attrs)
+                records.append(dict(u=u, v=v, geometry=geometry, **attrs))
+                osmid += 1
+
+    links = gpd.GeoDataFrame(records, crs=EPSGS["world"])
+    links = links[["osmid", "u", "v", "length", "highway", "geometry"]]
+    return net, links
+
+
+def make_spaths(links, sources):
+    """Shortest paths (as sequences of link osmids) between all ``sources``."""
+    nodes = pd.Index(np.union1d(links["u"], links["v"]))
+    u = nodes.get_indexer(np.r_[links["u"], links["v"]])
+    v = nodes.get_indexer(np.r_[links["v"], links["u"]])
+    osmids = np.r_[links["osmid"], links["osmid"]]
+    length = np.r_[links["length"], links["length"]]
+    graph = sparse.csr_matrix((length, (u, v)), shape=(len(nodes), len(nodes)))
+    edges = pd.MultiIndex.from_arrays([u, v])
+
+    sources = np.unique(sources)
+    codes = nodes.get_indexer(sources)
+    _, predecessors = csgraph.dijkstra(graph, indices=codes, return_predecessors=True)
+
+    keys, steps = [], []
+    for row, (source, code) in enumerate(zip(sources, codes)):
+        for target, target_code in zip(sources, codes):
+            if source == target:
+                continue
+            path = [target_code]
+            while path[-1] != code:
+                path.append(predecessors[row, path[-1]])
+            path = path[::-1]
+            keys.extend((source, target, k) for k in range(len(path) - 1))
+            steps.extend(zip(path[:-1], path[1:]))
+
+    index = pd.MultiIndex.from_tuples(keys, names=["source", "target", "seq"])
+    values = osmids[edges.get_indexer(pd.MultiIndex.from_tuples(steps))]
+    return pd.Series(values, index=index, name="osmid")
+
+
+def make_generation(nuts_ids, products, dates, rng):
+    index = pd.MultiIndex.from_product(
+        [dates, nuts_ids, products.index], names=["date", "nuts", "product_name"]
+    )
+    df = pd.DataFrame({"quantity_tn": rng.gamma(2.0, 50.0, len(index))}, index=index)
+    df["product_group"] = products.reindex(
+        index.get_level_values("product_name")
+    ).to_numpy()
+    df = df.set_index("product_group", append=True)
+    return df.reorder_levels(["date", "nuts", "product_group", "product_name"])
+
+
+def make_ods(nuts_ids, products, density, rng):
+    index = pd.MultiIndex.from_product(
+        [products.index, nuts_ids, nuts_ids],
+        names=["product_name", "origin_nuts", "destination_nuts"],
+    )
+    index = index[rng.random(len(index)) < density]
+    return pd.Series(rng.gamma(2.0, 20.0, len(index)), index=index, name="quantity_tn")
+
+
+def generate(
+    n_nuts=52,
+    n_products=30,
+    n_groups=6,
+    months=12,
+    start="2018-01-01",
+    grid=40,
+    density=0.5,
+    seed=0,
+):
+    """Random datasets with the layout of ``src.io.fetch_data()``."""
+    rng = np.random.default_rng(seed)
+    nuts = make_nuts(n_nuts, grid, rng)
+    nuts_ids = nuts.index[nuts["LEVL_CODE"] == 3]
+    net, links = make_network(grid, rng)
+
+    products = pd.Series(
+        [f"Ομάδα {k % n_groups:02d}" for k in range(n_products)],
+        index=pd.Index([f"Προϊόν {k:03d}" for k in range(n_products)]),
+        name="product_group",
+    )
+    dates = pd.date_range(start, periods=months, freq="MS", name="date")
+
+    return {
+        "nuts": nuts,
+        "distr": pd.DataFrame(),
+        "prods": make_generation(nuts_ids, products, dates, rng),
+        "cons": make_generation(nuts_ids, products, dates, rng),
+        "ods": make_ods(nuts_ids, products, density, rng),
+        "net": net,
+        "links": links,
+        "spaths": make_spaths(links, nuts.loc[nuts_ids, "osmid"].to_numpy()),
+        "epsgs": EPSGS,
+    }
+
+
+def save(data, path):
+    if path.endswith(".pkl"):
+        with open(path, "wb") as handle:
+            pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        write_data(data, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic dataset (a .pkl file or an Arrow directory)"
+    )
+    parser.add_argument("path")
+    parser.add_argument("--nuts", type=int, default=52)
+    parser.add_argument("--products", type=int, default=30)
+    parser.add_argument("--groups", type=int, default=6)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--start", default="2018-01-01")
+    parser.add_argument("--grid", type=int, default=40)
+    parser.add_argument("--density", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    data = generate(
+        n_nuts=args.nuts,
+        n_products=args.products,
+        n_groups=args.groups,
+        months=args.months,
+        start=args.start,
+        grid=args.grid,
+        density=args.density,
+        seed=args.seed,
+    )
+    save(data, args.path)
+    logger.info("wrote %s", args.path)
@@ -0,0 +1,130 @@
+import hashlib
+import os
+from functools import lru_cache
+
+import flask
+import pandas as pd
+import geopandas as gpd
+import mapbox_vector_tile
+from shapely.geometry import box
+
+from src import jobs
+from src.geometry import volume_classes
+from src.io import store
+
+TILE_CACHE = int(os.environ.get("AGRO_TILE_CACHE", 2048))
+TILE_URL = "/tiles/links/{key}/{z}/{x}/{y}.pbf"
+# Browser cache lifetime (s) of the tiles, which never change for a key
+TILE_MAX_AGE = 24 * 3600
+EXTENT = 4096
+# Features are clipped to the tile plus this margin (in tile units), so that
+# lines do not end at tile edges
+MARGIN = 64
+# Half the width of the web mercator world (m)
+ORIGIN = 20037508.342789244
+
+
+@store.derive("link_mercator")
+def build_link_mercator(store):
+    links = store["links"].set_index("osmid")
+    geometries = gpd.GeoSeries(links.geometry, crs=links.crs or store["epsgs"]["world"])
+    geometries = geometries.to_crs(epsg=3857)
+    geometries.sindex  # built once, shared by all the tiles
+    return geometries
+
+
+def tile_bounds(z, x, y):
+    size = 2 * ORIGIN / 2**z
+    return (
+        -ORIGIN + x * size,
+        ORIGIN - (y + 1) * size,
+        -ORIGIN + (x + 1) * size,
+        ORIGIN - y * size,
+    )
+
+
+def layer_name(k):
+    return f"volume-{k}"
+
+
+def publish(vols, bins=5):
+    """Make link volumes available to the tile route, returns their key.
+
+    The key is a hash of the volumes, so tiles of a key never change. They
+    are kept in the jobs cache, shared with the long callback processes,
+    until evicted.
+    """
+    key = hashlib.sha1(pd.util.hash_pandas_object(vols).to_numpy()).hexdigest()[:16]
+    edges, classes = volume_classes(vols, bins)
+    jobs.cache.set(
+        f"tiles:{key}",
+        pd.DataFrame({"volume": vols, "class": classes}),
+    )
+    return key, edges
+
+
+def tile_url(key):
+    return TILE_URL.format(key=key, z="{z}", x="{x}", y="{y}")
+
+
+@lru_cache(maxsize=32)
+def volumes(key):
+    # Raised, rather than returned, so that unknown keys are not cached
+    vols = jobs.cache.get(f"tiles:{key}")
+    if vols is None:
+        raise KeyError(key)
+    return vols
+
+
+@lru_cache(maxsize=TILE_CACHE)
+def render(key, z, x, y):
+    vols = volumes(key)
+
+    bounds = tile_bounds(z, x, y)
+    pixel = (bounds[2] - bounds[0]) / EXTENT
+    clip = box(*bounds).buffer(MARGIN * pixel, join_style=2)
+    links = store["link_mercator"]
+    hits = links.iloc[links.sindex.query(clip)]
+    hits = hits[hits.index.isin(vols.index)]
+    # Level of detail: at most one vertex per pixel and no sub-pixel links
+    lines = hits.simplify(pixel).intersection(clip)
+    lines = lines[~lines.is_empty & (lines.length >= pixel)]
+
+    attributes = vols.reindex(lines.index)
+    layers = {}
+    for osmid, geometry, volume, k in zip(
+        lines.index, lines, attributes["volume"], attributes["class"]
+    ):
+        layers.setdefault(int(k), []).append(
+            {
+                "geometry": geometry,
+                "properties": {"osmid": int(osmid), "volume": float(volume)},
+            }
+        )
+    return mapbox_vector_tile.encode(
+        [
+            {"name": layer_name(k), "features": features}
+            for k, features in sorted(layers.items())
+        ],
+        quantize_bounds=bounds,
+        extents=EXTENT,
+    )
+
+
+def tile(key, z, x, y):
+    try:
+        data = render(key, z, x, y)
+    except KeyError:
+        flask.abort(404)
+    response = flask.Response(data, mimetype="application/vnd.mapbox-vector-tile")
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    return response
+
+
+def init_app(server):
+    server.add_url_rule(
+        TILE_URL.format(key="<key>", z="<int:z>", x="<int:x>", y="<int:y>"),
+        "tile",
+        tile,
+    )
@@ -8,10 +8,12 @@ def pairwise(iterable):
 
 
 def rename_nuts(nuts, df, cols, trim_len):
-    for c in cols:
-        df[c] = df[c].replace(nuts["NUTS_NAME"].to_dict())
+    names = nuts["NUTS_NAME"].to_dict()
 
-    if trim_len:
-        for c in cols:
-            df[c] = df[c].str[0:trim_len]
-    return df
+    def rename(id):
+        name = names.get(id, id)
+        return name[0:trim_len] if trim_len else name
+
+    # On categorical columns only the categories are renamed. A new frame is
+    # returned, ``df`` may be shared with other requests
+    return df.assign(**{c: df[c].astype("category").map(rename) for c in cols})
@@ -0,0 +1,13 @@
+import pytest
+
+from src.io import store
+from src.synth import generate, save
+
+
+@pytest.fixture(scope="session")
+def data(tmp_path_factory):
+    """The store, serving a small synthetic data directory."""
+    path = str(tmp_path_factory.mktemp("data"))
+    save(generate(n_nuts=13, n_products=10, months=12, grid=20), path)
+    store.open(path)
+    return store
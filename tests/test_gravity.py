@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+
+from src import gravity
+from src.io import MANIFEST
+
+
+def test_gravity_tolerance(data):
+    year = data.years()[-1]
+    origins = gravity.totals("prods", year, data["nuts_costs"].index)
+    loose = gravity.gravity_tensor(year, tolerance=0.5)
+    tight = gravity.gravity_tensor(year, tolerance=1e-8)
+
+    produced = tight.values.sum(axis=2)
+    expected = origins.reindex(tight.products, fill_value=0).to_numpy()
+    np.testing.assert_allclose(produced, expected, rtol=1e-6, atol=1e-6)
+    assert not np.allclose(loose.values, tight.values)
+
+
+def test_gravity_follows_the_store_version(data):
+    first = gravity.gravity_tensor(data.years()[-1])
+    assert gravity.gravity_tensor(data.years()[-1]) is first
+
+    manifest = os.path.join(data.path, MANIFEST)
+    stat = os.stat(manifest)
+    os.utime(manifest, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert gravity.gravity_tensor(data.years()[-1]) is not first
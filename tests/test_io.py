@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import gravity, network  # noqa: F401, derives nuts_costs
+from src.io import partition
+
+
+def test_frames_are_handed_out_as_copies(data):
+    nuts = data["nuts3"]
+    osmids = nuts["osmid"].copy()
+    nuts["x"] = 1
+    nuts["osmid"] = 0
+
+    assert "x" not in data["nuts3"]
+    pd.testing.assert_series_equal(data["nuts3"]["osmid"], osmids)
+
+
+def test_arrays_are_read_only(data):
+    costs = data["nuts_costs"]
+    with pytest.raises(ValueError):
+        costs.iloc[0, 0] = 0
+    with pytest.raises(ValueError):
+        costs.iloc[:, 0].to_numpy()[0] = 0
+    with pytest.raises(ValueError):
+        data["incidence"].matrix.data[0] = 0
+    assert np.isfinite(data["nuts_costs"].iloc[0, 0])
+
+
+def test_concurrent_loads(data):
+    year = data.years()[-1]
+    ods = data[partition("ods", year)]
+    origins = list(ods.index.get_level_values("origin_nuts").unique()[:3])
+    closed = int(data["incidence"].links[0])
+    cases = [
+        lambda: network.assign_selection(year=year)[0],
+        lambda: network.assign_selection(origins=origins, year=year)[0],
+        lambda: network.close_links([closed], year=year)[0].to_numpy(),
+        lambda: network.select_link(closed, year=year).to_numpy(),
+    ]
+    references = [case() for case in cases]
+
+    # Cold stores: the threads load the datasets and fill the path caches
+    for _ in range(10):
+        data.open(data.path)
+        network.closed_engine.cache_clear()
+        with ThreadPoolExecutor(16) as pool:
+            results = list(pool.map(lambda i: cases[i % len(cases)](), range(32)))
+
+        for i, result in enumerate(results):
+            np.testing.assert_array_equal(result, references[i % len(cases)])
@@ -0,0 +1,36 @@
+import numpy as np
+
+from src import network
+
+
+def test_close_links_reroutes(data):
+    year = data.years()[-1]
+    base, _ = network.assign_selection(year=year)
+    closed = int(data["incidence"].links[np.argmax(base)])
+
+    volumes, stranded = network.close_links([closed], year=year)
+    assert volumes.loc[closed, "scenario"] == 0
+    np.testing.assert_allclose(volumes["base"].sum(), base.sum())
+    assert volumes["scenario"].sum() > 0
+    assert stranded >= 0
+
+
+def test_close_links_without_affected_flows(data):
+    year = data.years()[-1]
+    closed = int(data["incidence"].links[0])
+
+    volumes, stranded = network.close_links([closed], ["unknown"], year=year)
+    assert stranded == 0
+    assert (volumes["scenario"] == volumes["base"]).all()
+
+
+def test_close_unknown_link(data):
+    year = data.years()[-1]
+    volumes, stranded = network.close_links([-1], year=year)
+    assert stranded == 0
+    np.testing.assert_array_equal(volumes["scenario"], volumes["base"])
+
+
+def test_path_table_without_pairs(data):
+    keys, osmids = data["path_engine"].path_table([])
+    assert len(keys) == 0 and len(osmids) == 0
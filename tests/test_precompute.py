@@ -0,0 +1,37 @@
+import json
+import os
+
+import pytest
+
+from src.io import DERIVED, MANIFEST, store
+from src.precompute import precompute
+from src.synth import generate, save
+
+
+@pytest.fixture
+def directory(tmp_path, data):
+    path = str(tmp_path / "data")
+    save(generate(n_nuts=6, n_products=4, months=2, grid=8), path)
+    yield path
+    store.open(data.path)
+
+
+def derived(path):
+    with open(os.path.join(path, MANIFEST)) as handle:
+        return json.load(handle)[DERIVED]
+
+
+def test_stage_run_keeps_other_artifacts(directory):
+    precompute(directory)
+    before = derived(directory)
+
+    precompute(directory, ["products"])
+    assert derived(directory) == before
+    for artifact in before.values():
+        assert os.path.exists(os.path.join(directory, artifact))
+
+
+def test_unchanged_stages_are_reused(directory):
+    precompute(directory, ["nuts3", "products"])
+    before = derived(directory)
+    assert precompute(directory, ["nuts3", "products"]) == before